@@ -1,21 +1,42 @@
 from flask import Flask, render_template, request, \
-    flash, send_file, send_from_directory, abort
+    flash, send_file, send_from_directory, abort, Response, \
+    stream_with_context
 from linked_list_simulator.linked_list import *
 from huffman_compressor.engine import *
 from tower_of_hanoi.tower_of_hanoi import *
+from file_management.temp_files import TempFileManager
+from file_management.result_cache import ResultCache, content_hash
+import io
 import os
-from datetime import datetime, timedelta
+import unicodedata
+from urllib.parse import quote
 from apscheduler.schedulers.background import BackgroundScheduler
 
-garbage_files = []
-
-scheduler = BackgroundScheduler()
-scheduler.start()
-
 app = Flask(__name__)
 
 app.config["FILE_UPLOADS"] = \
     r"/var/www/webApp/webApp/client_files"
+# the number of seconds an output file is kept in FILE_UPLOADS, and the most
+# bytes the output files can take up in total
+app.config["TEMP_FILE_TTL"] = 10
+app.config["TEMP_FILE_QUOTA"] = 1 << 30
+# if True, uploads are compressed and decompressed as they are read and the
+# result is streamed back, instead of being staged in FILE_UPLOADS
+app.config["STREAM_RESPONSES"] = True
+# where the results of earlier uploads are cached, and the most bytes they
+# can take up in total
+app.config["RESULT_CACHE"] = \
+    os.path.join(app.config["FILE_UPLOADS"], "cache")
+app.config["RESULT_CACHE_QUOTA"] = 1 << 30
+
+temp_files = TempFileManager(app.config["TEMP_FILE_TTL"],
+                             app.config["TEMP_FILE_QUOTA"])
+results = ResultCache(app.config["RESULT_CACHE"],
+                      app.config["RESULT_CACHE_QUOTA"])
+
+scheduler = BackgroundScheduler()
+scheduler.add_job(func=temp_files.sweep, trigger='interval', seconds=1)
+scheduler.start()
 
 
 @app.route("/")
@@ -28,8 +49,18 @@ def home():
 def compress():
     if request.method == "POST":
         if request.files:
+            file = request.files['file']
+            if file.filename == '':
+                return render_template("compress.html", error='NoFileError')
+            key = 'compress-' + content_hash(file.stream)
+            cached = results.get(key)
+            if cached is not None:
+                return send_file(cached, as_attachment=True,
+                                 download_name=file.filename.split('.')[0] +
+                                 '.djerty')
+            if app.config["STREAM_RESPONSES"]:
+                return stream_compressed(file, key)
             try:
-                file = request.files['file']
                 file.save(os.path.join(app.config["FILE_UPLOADS"],
                                        file.filename))
                 compress_file(os.path.join(app.config["FILE_UPLOADS"],
@@ -37,12 +68,12 @@ def compress():
                               os.path.join(app.config["FILE_UPLOADS"],
                                            file.filename.split('.')[0] +
                                            '.djerty'))
-                garbage_files.append(os.path.join(app.config['FILE_UPLOADS'],
-                                                  file.filename.split('.')[0] +
-                                                  '.djerty'))
-                scheduler.add_job(func=clear_garbage_files,
-                                  next_run_time=datetime.now() +
-                                                timedelta(seconds=10))
+                temp_files.add(os.path.join(app.config['FILE_UPLOADS'],
+                                            file.filename.split('.')[0] +
+                                            '.djerty'))
+                results.add(key, os.path.join(app.config['FILE_UPLOADS'],
+                                              file.filename.split('.')[0] +
+                                              '.djerty'))
                 os.remove(os.path.join(app.config["FILE_UPLOADS"],
                                        file.filename))
                 return send_file(os.path.join(app.config["FILE_UPLOADS"],
@@ -71,6 +102,14 @@ def decompress():
                     return render_template("decompress.html", error='NoFileError')
                 elif file.filename[-7:] != '.djerty':
                     return render_template('decompress.html', error="NotADjertyFile")
+                key = 'decompress-' + content_hash(file.stream)
+                cached = results.get(key)
+                if cached is not None:
+                    return send_file(cached, as_attachment=True,
+                                     download_name=file.filename.split('.')[0]
+                                     + extension)
+                if app.config["STREAM_RESPONSES"]:
+                    return stream_decompressed(file, extension, key)
                 file.save(os.path.join(app.config["FILE_UPLOADS"],
                                        file.filename))
                 decompress_file(os.path.join(app.config["FILE_UPLOADS"],
@@ -78,12 +117,12 @@ def decompress():
                               os.path.join(app.config["FILE_UPLOADS"],
                                            file.filename.split('.')[0] +
                                            extension))
-                garbage_files.append(os.path.join(app.config['FILE_UPLOADS'],
-                                                  file.filename.split('.')[0] +
-                                                  extension))
-                scheduler.add_job(func=clear_garbage_files,
-                                  next_run_time=datetime.now() +
-                                                timedelta(seconds=10))
+                temp_files.add(os.path.join(app.config['FILE_UPLOADS'],
+                                            file.filename.split('.')[0] +
+                                            extension))
+                results.add(key, os.path.join(app.config['FILE_UPLOADS'],
+                                              file.filename.split('.')[0] +
+                                              extension))
                 os.remove(os.path.join(app.config["FILE_UPLOADS"],
                                        file.filename))
                 return send_file(os.path.join(app.config["FILE_UPLOADS"],
@@ -91,15 +130,116 @@ def decompress():
                                               extension))
             except FileNotFoundError:
                 return render_template("decompress.html", error='NoFileError')
+            except DjertyFileError:
+                for path in (os.path.join(app.config["FILE_UPLOADS"],
+                                          file.filename),
+                             os.path.join(app.config["FILE_UPLOADS"],
+                                          file.filename.split('.')[0] +
+                                          extension)):
+                    if os.path.exists(path):
+                        os.remove(path)
+                return render_template('decompress.html',
+                                       error="NotADjertyFile")
     return render_template("decompress.html")
 
 
-def clear_garbage_files():
-    for path in garbage_files:
+def upload_chunks(file):
+    """ Return an iterator over the contents of the uploaded <file>,
+    CHUNK_SIZE bytes at a time.
+
+    The file is detached from the request, since the request closes its
+    files as soon as the view returns, while a streamed response is still
+    reading from them.
+    """
+    stream = file.stream
+    file.stream = io.BytesIO()
+
+    def generate():
         try:
-            os.remove(path)
-        except FileNotFoundError:
-            continue
+            chunk = stream.read(CHUNK_SIZE)
+            while chunk:
+                yield chunk
+                chunk = stream.read(CHUNK_SIZE)
+        finally:
+            stream.close()
+
+    return generate()
+
+
+def download(chunks, filename):
+    """ Return a response that sends <chunks> as they are produced, as a file
+    named <filename>.
+
+    The file name is given in the Content-Disposition header the same way
+    send_file gives it: quoted, and also in UTF-8 (RFC 5987) if it is not
+    ASCII, with an ASCII version for clients that do not support that.
+    """
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename)
+        simple = simple.encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': simple,
+                 'filename*': "UTF-8''" + quote(filename,
+                                                safe="!#$&+-.^_`|~")}
+    else:
+        names = {'filename': filename}
+    response = Response(stream_with_context(chunks),
+                        mimetype='application/octet-stream')
+    response.headers.set('Content-Disposition', 'attachment', **names)
+    return response
+
+
+def stream_compressed(file, key):
+    """ Return a response that compresses the uploaded <file> while it is
+    being sent, without staging it on disk, and caches the result under
+    <key>.
+
+    How it is compressed is chosen from a sample of <file> (see
+    choose_strategy): it is only stored if it would barely shrink, and large
+    files are compressed in parallel.
+    """
+    size = file.stream.seek(0, os.SEEK_END)
+    file.stream.seek(0)
+    strategy = choose_strategy(sample_frequencies(file.stream), size)
+    chunks = compress_stream(upload_chunks(file),
+                             stored=strategy == STRATEGY_STORED,
+                             parallel=strategy == STRATEGY_PARALLEL)
+    return download(results.store(key, chunks),
+                    file.filename.split('.')[0] + '.djerty')
+
+
+def stream_decompressed(file, extension, key):
+    """ Return a response that decompresses the uploaded <file> while it is
+    being sent, as a file with the extension <extension>, and caches the
+    result under <key>.
+
+    The file is read until its header has been decompressed (or until it
+    ends) before the response starts, so that a file with an invalid header
+    is reported on the page instead.
+    """
+    chunks = upload_chunks(file)
+    decompressor = Decompressor()
+    first = []
+    try:
+        while not decompressor.header_read:
+            chunk = next(chunks, None)
+            if chunk is None:
+                first.append(decompressor.flush())
+                break
+            first.append(decompressor.update(chunk))
+    except DjertyFileError:
+        chunks.close()
+        return render_template('decompress.html', error="NotADjertyFile")
+
+    def generate():
+        yield from first
+        for chunk in chunks:
+            yield decompressor.update(chunk)
+        decompressor.flush()
+
+    return download(results.store(key, generate()),
+                    file.filename.split('.')[0] + extension)
 
 
 # @app.route("/get_file/<file_name>")
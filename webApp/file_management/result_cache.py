@@ -0,0 +1,212 @@
+"""
+=== Module Description ===
+This module contains ResultCache, an on-disk cache of the files that the web
+app produces, keyed by a hash of the file they were produced from, so that a
+file that is uploaded again can be sent straight from the cache.
+"""
+from __future__ import annotations
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import BinaryIO, Iterable, Iterator, Optional
+
+# The number of bytes read at a time when hashing a file.
+HASH_CHUNK_SIZE = 1 << 20
+
+# The number of seconds after which a result that is still being stored is
+# taken to have been abandoned. Until then, it may belong to another process
+# that shares the directory, which is still writing it.
+STALE_PART_AGE = 60 * 60
+
+
+def content_hash(stream: BinaryIO) -> str:
+    """Return the SHA-256 hash of the rest of <stream>, as a hex string, and
+    move <stream> back to where it was.
+
+    >>> import io
+    >>> stream = io.BytesIO(b'hello')
+    >>> content_hash(stream)[:16], stream.tell()
+    ('2cf24dba5fb0a30e', 0)
+    """
+    start = stream.tell()
+    digest = hashlib.sha256()
+    chunk = stream.read(HASH_CHUNK_SIZE)
+    while chunk:
+        digest.update(chunk)
+        chunk = stream.read(HASH_CHUNK_SIZE)
+    stream.seek(start)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """An on-disk cache of results, which deletes the least recently used
+    results once they take up more than <quota> bytes.
+
+    The directory is only created, and the results already in it from an
+    earlier run only indexed, the first time the cache is used.
+
+    === Public Attributes ===
+    directory:
+        The directory the results are stored in.
+    quota:
+        The largest number of bytes the results can take up.
+    hits:
+        The number of lookups that found a result.
+    misses:
+        The number of lookups that did not find a result.
+
+    >>> directory = tempfile.mkdtemp()
+    >>> cache = ResultCache(directory, quota=8)
+    >>> cache.get('a') is None
+    True
+    >>> b''.join(cache.store('a', [b'hel', b'lo']))
+    b'hello'
+    >>> with cache.get('a') as f:
+    ...     f.read()
+    b'hello'
+    >>> b''.join(cache.store('b', [b'world']))
+    b'world'
+    >>> cache.get('a') is None, cache.hits, cache.misses, cache.bytes_on_disk
+    (True, 1, 2, 5)
+    """
+    directory: str
+    quota: int
+    hits: int
+    misses: int
+
+    # === Private Attributes ===
+    # _sizes:
+    #     The size of every result, by key, from the least recently used to
+    #     the most recently used, or None if the directory has not been
+    #     indexed yet.
+    # _bytes:
+    #     The total size of the results.
+    # _lock:
+    #     The lock that is taken before changing _sizes.
+    _sizes: Optional[OrderedDict[str, int]]
+    _bytes: int
+    _lock: threading.Lock
+
+    def __init__(self, directory: str, quota: int) -> None:
+        """Initialize a new cache that stores up to <quota> bytes of results in
+        <directory>.
+        """
+        self.directory = directory
+        self.quota = quota
+        self.hits = 0
+        self.misses = 0
+        self._sizes = None
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def bytes_on_disk(self) -> int:
+        """Return the total size of the results."""
+        return self._bytes
+
+    def get(self, key: str) -> Optional[BinaryIO]:
+        """Return the result for <key>, open for reading, or None if there is
+        none.
+
+        The result is opened before the lock is released, so it can still be
+        read even if it is deleted to make room for another result.
+        """
+        with self._lock:
+            self._index()
+            if key in self._sizes:
+                try:
+                    f = open(self._path(key), 'rb')
+                except FileNotFoundError:
+                    # deleted from outside the cache
+                    self._bytes -= self._sizes.pop(key)
+                else:
+                    self._sizes.move_to_end(key)
+                    self.hits += 1
+                    return f
+            self.misses += 1
+            return None
+
+    def store(self, key: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """Yield every chunk of <chunks>, and store them as the result for
+        <key> once they have all been yielded.
+
+        Nothing is stored if the chunks are not all yielded, or if producing
+        them raises an error.
+        """
+        with self._lock:
+            self._index()
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+        except BaseException:
+            os.remove(temp)
+            raise
+        self._add(key, temp)
+
+    def add(self, key: str, path: str) -> None:
+        """Store a copy of the file at <path> as the result for <key>."""
+        with self._lock:
+            self._index()
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        with os.fdopen(fd, 'wb') as f, open(path, 'rb') as g:
+            chunk = g.read(HASH_CHUNK_SIZE)
+            while chunk:
+                f.write(chunk)
+                chunk = g.read(HASH_CHUNK_SIZE)
+        self._add(key, temp)
+
+    def _add(self, key: str, temp: str) -> None:
+        """Move the finished file at <temp> into place as the result for
+        <key>, and delete the least recently used results if they take up
+        more than the quota.
+        """
+        size = os.path.getsize(temp)
+        with self._lock:
+            os.replace(temp, self._path(key))
+            self._bytes += size - self._sizes.pop(key, 0)
+            self._sizes[key] = size
+            while self._bytes > self.quota and self._sizes:
+                old_key, old_size = self._sizes.popitem(last=False)
+                self._bytes -= old_size
+                try:
+                    os.remove(self._path(old_key))
+                except FileNotFoundError:
+                    pass
+
+    def _index(self) -> None:
+        """Create the directory and index the results already in it, from the
+        least recently modified, if that has not been done yet, and delete
+        the results that were abandoned before they were stored. The lock
+        must be held.
+        """
+        if self._sizes is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.part'):
+                # left over from a result that was never finished, unless it
+                # is recent enough to still be stored by another process
+                try:
+                    if now - entry.stat().st_mtime > STALE_PART_AGE:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+            elif entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        self._sizes = OrderedDict()
+        for _, name, size in sorted(entries):
+            self._sizes[name] = size
+            self._bytes += size
+
+    def _path(self, key: str) -> str:
+        """Return the path of the result for <key>."""
+        return os.path.join(self.directory, key)
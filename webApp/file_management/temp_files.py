@@ -0,0 +1,111 @@
+"""
+=== Module Description ===
+This module contains TempFileManager, which keeps track of the temporary files
+that the web app writes to disk, and deletes them once they have expired or
+once they take up more space than they are allowed to.
+"""
+from __future__ import annotations
+import os
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+
+class TempFileManager:
+    """A manager of temporary files, each of which is deleted <ttl> seconds
+    after it was added, or earlier if the files take up more than <quota>
+    bytes in total.
+
+    Every file lives for the same amount of time, so the files expire in the
+    order they were added: adding a file and expiring the oldest one both take
+    constant time, and a sweep only looks at the files it deletes.
+
+    === Public Attributes ===
+    ttl:
+        The number of seconds each file is kept for.
+    quota:
+        The largest number of bytes the files can take up, or None if there
+        is no limit.
+
+    >>> import tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> manager = TempFileManager(ttl=0, quota=None)
+    >>> path = os.path.join(directory, 'a')
+    >>> with open(path, 'wb') as f:
+    ...     _ = f.write(b'hello')
+    >>> manager.add(path)
+    >>> manager.bytes_on_disk
+    5
+    >>> manager.sweep()
+    1
+    >>> os.path.exists(path), manager.bytes_on_disk
+    (False, 0)
+    """
+    ttl: float
+    quota: Optional[int]
+
+    # === Private Attributes ===
+    # _files:
+    #     The (expiry time, path, size) of every file that has not been
+    #     deleted yet, from the oldest to the newest.
+    # _bytes:
+    #     The total size of the files in _files.
+    # _lock:
+    #     The lock that the sweeper and the request handlers take before
+    #     changing _files.
+    _files: deque[tuple[float, str, int]]
+    _bytes: int
+    _lock: threading.Lock
+
+    def __init__(self, ttl: float, quota: Optional[int] = None) -> None:
+        """Initialize a new manager that keeps files for <ttl> seconds, and
+        keeps them under <quota> bytes in total.
+        """
+        self.ttl = ttl
+        self.quota = quota
+        self._files = deque()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def bytes_on_disk(self) -> int:
+        """Return the total size of the files that have not been deleted yet.
+        """
+        return self._bytes
+
+    def add(self, path: str) -> None:
+        """Start keeping track of the file at <path>, and delete the oldest
+        files if they take up more than the quota.
+
+        The file at <path> itself is never deleted here, even if it is larger
+        than the quota on its own, since it is about to be sent.
+        """
+        size = os.path.getsize(path)
+        with self._lock:
+            self._files.append((time.monotonic() + self.ttl, path, size))
+            self._bytes += size
+            while (self.quota is not None and self._bytes > self.quota
+                   and len(self._files) > 1):
+                self._delete_oldest()
+
+    def sweep(self) -> int:
+        """Delete every file that has expired, and return how many there were.
+        """
+        now = time.monotonic()
+        count = 0
+        with self._lock:
+            while self._files and self._files[0][0] <= now:
+                self._delete_oldest()
+                count += 1
+        return count
+
+    def _delete_oldest(self) -> None:
+        """Delete the oldest file. The lock must be held.
+        """
+        _, path, size = self._files.popleft()
+        self._bytes -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
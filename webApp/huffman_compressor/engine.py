@@ -1,10 +1,85 @@
 from __future__ import annotations
 
+import functools
+import heapq
+import math
+import mmap
+import os
+import struct
+import threading
 import time
 
-from typing import Optional, Any
-from huffman_compressor.huffman import HuffmanTree
+from array import array
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Optional, Any, BinaryIO, Callable, Iterable, Iterator, \
+    Sequence
+from huffman_compressor.huffman import HuffmanTree, FlatHuffmanTree
 from huffman_compressor.utils import *
+from huffman_compressor.models import MODEL_NAMES, MODELS
+
+try:
+    import numpy
+except ImportError:  # NumPy is optional; the pure Python paths are used.
+    numpy = None
+
+# the smallest input for which bytes are counted with NumPy rather than with
+# collections.Counter
+_NUMPY_MIN_SIZE = 1 << 12
+
+# the length of the prefix of an input in which _count_bytes looks for the
+# order that its bytes first appear in, before it searches the rest of it
+_FIRST_SEEN_PREFIX = 1 << 12
+
+# the largest total number of tree nodes of the decode tables kept for the
+# tree (or code length) headers that were decompressed most recently, so that
+# files sharing a header only build its table once. A filled table takes up
+# to about 16 KiB per node (256 entries, each with a bytes object of up to 8
+# symbols), so each of the two caches holds at most about 16 MiB: 4 tables
+# for all 256 symbols, or many more small ones.
+_DECODE_TABLE_CACHE_NODES = 1024
+
+# the number of bytes read from a file at a time when it is processed in chunks
+CHUNK_SIZE = 1 << 20
+
+# Every .djerty file other than a legacy (version 1) one starts with MAGIC
+# followed by a version byte. A version 1 file starts with its number of tree
+# nodes instead, which is never 0, so the two can always be told apart.
+MAGIC = bytes([0]) + b'DJT'
+VERSION_BLOCKS = 2
+VERSION_LARGE = 3
+
+# the size of the largest input that fits in the 4-byte size of a version 1
+# file. Larger inputs are written as version 3 files, which are laid out like
+# version 1 files (after MAGIC and the version byte), but with an 8-byte size.
+_LEGACY_MAX_SIZE = (1 << 32) - 1
+
+# the legacy (version 1) file of an empty input, which has a number of nodes
+# of 1 but no nodes, since its tree is empty
+_LEGACY_EMPTY_FILE = bytes([1, 0, 0, 0, 0])
+
+# the default and largest number of input bytes in a block of a version 2
+# file (the largest is chosen so that a compressed block always fits in the
+# 4-byte lengths of the file format)
+BLOCK_SIZE = 1 << 20
+MAX_BLOCK_SIZE = 1 << 27
+
+# the largest payload of a block of a version 2 file: twice the largest
+# block size (since no code of a built-in model is longer than 16 bits, and
+# the codes of a Huffman tree are shorter than that on average), plus the
+# tree or code lengths stored before the compressed text
+_MAX_PAYLOAD_LENGTH = 2 * MAX_BLOCK_SIZE + 1024
+
+# the flags of a version 2 file
+_FLAG_INDEXED = 1
+
+# the types of the blocks in a version 2 file
+_BLOCK_TREE = 0
+_BLOCK_CANONICAL = 1
+_BLOCK_MODEL = 2
+_BLOCK_STORED = 3
+_BLOCK_END = 0xFF
 
 
 class EmptyStackError(Exception):
@@ -15,6 +90,20 @@ class EmptyStackError(Exception):
         return 'You called pop on an empty stack.'
 
 
+class DjertyFileError(Exception):
+    """ An exception raised when a file that is being decompressed is not a
+    valid .djerty file. """
+
+    def __init__(self, reason: str = 'it is malformed') -> None:
+        """ Initialize this error, which happened because of <reason>. """
+        Exception.__init__(self, reason)
+        self.reason = reason
+
+    def __str__(self) -> str:
+        """Return a string representation of this error."""
+        return f'This is not a valid .djerty file: {self.reason}.'
+
+
 class _OrderedStack:
     """ An ordered list implementation of the stack ADT that stores
     items in a certain order. NOTE: This is an abstract class and should not
@@ -261,21 +350,6 @@ class _OrderedStackFrequency:
         return str(self)
 
 
-class _Counter:
-    """ An object that keeps track of a count.
-    === Public Attributes ===
-    count: the value of this Counter
-    """
-    count: int
-
-    def __init__(self) -> None:
-        """ Initialize this counter. Starts with initial value 0. """
-        self.count = 0
-
-    def __repr__(self) -> str:
-        """ Return a representation of this Counter for use in the console."""
-        return str(self.count)
-
 # ====================
 # Functions for compression
 
@@ -292,22 +366,86 @@ def build_frequency_dict(text: bytes) -> dict[int, int]:
     >>> build_frequency_dict(bytes([]))
     {}
     """
-    ans = {}
-    for byte in text:
-        if byte in ans:
-            ans[byte] += 1
-        else:
-            ans[byte] = 1
-    if len(ans) == 1:
-        dummy = 0 if list(ans.keys())[0] != 0 else 1
-        ans[dummy] = 0
+    ans = _count_bytes(text)
+    _add_dummy_symbol(ans)
     return ans
 
 
-def build_huffman_tree(freq_dict: dict[int, int]) -> HuffmanTree:
+def _add_dummy_symbol(freq_dict: dict[int, int]) -> None:
+    """ Mutate <freq_dict> so that, if it has only one symbol, it also has a
+    "dummy" symbol with frequency 0 (so that the Huffman tree has a root with
+    two children).
+
+    >>> d = {0: 3}
+    >>> _add_dummy_symbol(d)
+    >>> d
+    {0: 3, 1: 0}
+    """
+    if len(freq_dict) == 1:
+        dummy = 0 if list(freq_dict.keys())[0] != 0 else 1
+        freq_dict[dummy] = 0
+
+
+def _merge_frequencies(freq_dict: dict[int, int],
+                       other: dict[int, int]) -> None:
+    """ Mutate <freq_dict> by adding the frequencies in <other> to it. Symbols
+    that are new to <freq_dict> are added after its existing ones, so merging
+    the counts of consecutive chunks of a text gives the same dictionary as
+    counting the whole text at once.
+
+    >>> d = _count_bytes(b'abc')
+    >>> _merge_frequencies(d, _count_bytes(b'dca'))
+    >>> d == _count_bytes(b'abcdca') and list(d) == [97, 98, 99, 100]
+    True
+    """
+    for byte in other:
+        freq_dict[byte] = freq_dict.get(byte, 0) + other[byte]
+
+
+def _count_bytes(text: bytes) -> dict[int, int]:
+    """ Return a dictionary which maps each of the bytes in <text> to its
+    frequency, with the bytes in the order they first appear in <text>.
+
+    The bytes are counted in C, using numpy.bincount if NumPy is installed
+    and <text> is large enough for it to pay off, or collections.Counter
+    otherwise. <text> may be any bytes-like object, including a memoryview.
+
+    >>> _count_bytes(b'abracadabra')
+    {97: 5, 98: 2, 114: 2, 99: 1, 100: 1}
+    >>> _count_bytes(b'abracadabra' * 1000) == {97: 5000, 98: 2000, \
+    114: 2000, 99: 1000, 100: 1000}
+    True
+    """
+    if numpy is None or len(text) < _NUMPY_MIN_SIZE:
+        # Counter keeps its keys in insertion order, which is the order in
+        # which the bytes first appear.
+        return dict(Counter(text))
+    counts = numpy.bincount(numpy.frombuffer(text, dtype=numpy.uint8),
+                            minlength=256).tolist()
+    # find the order in which the bytes first appear from a short prefix of
+    # <text>, which usually has all of them, and search for the first
+    # occurrence of any other byte in C.
+    order = list(dict.fromkeys(text[:_FIRST_SEEN_PREFIX]))
+    seen = set(order)
+    missing = [byte for byte in range(256) if counts[byte] and byte not in seen]
+    if missing:
+        haystack = text if isinstance(text, bytes) else bytes(text)
+        order += sorted(missing, key=lambda byte: haystack.find(byte))
+    return {byte: counts[byte] for byte in order}
+
+
+def build_huffman_tree(freq_dict: dict[int, int],
+                       legacy_ties: bool = True) -> HuffmanTree:
     """ Return the Huffman tree corresponding to the frequency dictionary
     <freq_dict>.
 
+    Trees with equal frequencies are joined in the order they were created,
+    where the leaves are created in the iteration order of <freq_dict> if
+    <legacy_ties> is True (which gives the same trees, and hence the same
+    compressed files, as earlier versions of this module), or in increasing
+    order of their symbols otherwise (so that the tree does not depend on the
+    order in which the symbols first appeared).
+
     Precondition: freq_dict is not empty.
 
     >>> freq = {2: 6, 3: 4}
@@ -321,6 +459,13 @@ def build_huffman_tree(freq_dict: dict[int, int]) -> HuffmanTree:
                              HuffmanTree(None, HuffmanTree(3), HuffmanTree(7)))
     >>> t == result
     True
+    >>> freq = {9: 1, 4: 1, 8: 2}
+    >>> build_huffman_tree(freq) == HuffmanTree(None, HuffmanTree(8), \
+    HuffmanTree(None, HuffmanTree(9), HuffmanTree(4)))
+    True
+    >>> build_huffman_tree(freq, legacy_ties=False) == HuffmanTree(None, \
+    HuffmanTree(8), HuffmanTree(None, HuffmanTree(4), HuffmanTree(9)))
+    True
     >>> import random
     >>> symbol = random.randint(0,255)
     >>> freq = {symbol: 6}
@@ -335,9 +480,24 @@ def build_huffman_tree(freq_dict: dict[int, int]) -> HuffmanTree:
     """
     if len(freq_dict) == 0:
         return HuffmanTree()
+    return _build_flat_tree(freq_dict, legacy_ties).to_tree()
+
+
+def _build_flat_tree(freq_dict: dict[int, int],
+                     legacy_ties: bool = True) -> FlatHuffmanTree:
+    """ Return the Huffman tree corresponding to the frequency dictionary
+    <freq_dict>, built as a FlatHuffmanTree without any HuffmanTree objects.
+    This is the same tree that build_huffman_tree returns.
+
+    Precondition: freq_dict is not empty.
+
+    >>> flat = _build_flat_tree({2: 6, 3: 4, 7: 5})
+    >>> list(flat.left), list(flat.right)
+    ([3, 2], [7, 256])
+    """
     # if the length of freq_dict is 1, then we need to add a "dummy byte" to a
     # copy of it (so that we don't mutate it)
-    elif len(freq_dict) == 1:
+    if len(freq_dict) == 1:
         copy = {}
         for byte in freq_dict:
             copy.setdefault(byte, freq_dict[byte])
@@ -345,57 +505,31 @@ def build_huffman_tree(freq_dict: dict[int, int]) -> HuffmanTree:
             copy[dummy] = 0
     else:
         copy = freq_dict
-
-    # Now, take every element in the copy dictionary and push it (in order!)
-    # into an OrderedStack. The items at the top of the stack will have the
-    # least frequency, and the items at the bottom will have greater frequency.
-    stack = _OrderedStackHuffmanTree()
-    for byte in copy:
-        node = HuffmanTree(byte)
-        node.number = copy[byte]
-        stack.ordered_insert(node)
-    # In this step, two elements are popped off the stack simultaneously, and
-    # are joined using a helper function, and then the resultant tree is pushed
-    # (in order!) back onto the stack, until one tree remains on the stack.
-    while not stack.one_more():
-        stack.ordered_insert(_join_trees(stack.pop(), stack.pop()))
-    # Finally, pop the remaining tree of the stack and clear the temporary
-    # number attributes added to each of its nodes using a helper function.
-    final = stack.pop()
-    _clear_numbers(final)
-    return final
-
-
-def _join_trees(t1: HuffmanTree, t2: HuffmanTree) -> HuffmanTree:
-    """ Returns a HuffmanTree with children t1 and t2. """
-    joined = HuffmanTree(None, t1, t2)
-    joined.number = t1.number + t2.number
-    return joined
-
-
-def _clear_numbers(t: HuffmanTree) -> None:
-    """ Mutates <t> such that all nodes in it have number attribute None.
-    >>> tree = HuffmanTree()
-    >>> tree.number = 1
-    >>> _clear_numbers(tree)
-    >>> tree.number is None
-    True
-    >>> tree.number = 1
-    >>> left = HuffmanTree(2)
-    >>> left.number = 2
-    >>> right = HuffmanTree(3)
-    >>> right.number = 3
-    >>> tree.left = left
-    >>> tree.right = right
-    >>> _clear_numbers(tree)
-    """
-    if t.is_leaf():
-        t.number = None
-        return
-    else:
-        t.number = None
-        _clear_numbers(t.right)
-        _clear_numbers(t.left)
+    symbols = list(copy) if legacy_ties else sorted(copy)
+
+    # Now, push a leaf for every symbol onto a heap of (frequency, order, tree)
+    # entries, where order is a counter that is increased for every tree
+    # pushed, so that trees with the same frequency are popped in the order
+    # they were pushed. A tree is a symbol, or 256 plus the index of an
+    # internal node in <left> and <right>, which are in the order the nodes
+    # are made.
+    heap = [(copy[byte], order, byte) for order, byte in enumerate(symbols)]
+    heapq.heapify(heap)
+    order = len(heap)
+    left, right = [], []
+    # In this step, the two trees with the least frequencies are popped off the
+    # heap and joined, and then the resultant tree is pushed back onto the
+    # heap, until one tree remains on the heap.
+    while len(heap) > 1:
+        number1, _, tree1 = heapq.heappop(heap)
+        number2, _, tree2 = heapq.heappop(heap)
+        left.append(tree1)
+        right.append(tree2)
+        heapq.heappush(heap, (number1 + number2, order, 256 + len(left) - 1))
+        order += 1
+    # Finally, put the nodes in postorder, starting from the last one made,
+    # which is the root.
+    return FlatHuffmanTree.from_children(left, right, len(left) - 1)
 
 
 def get_codes(tree: HuffmanTree) -> dict[int, str]:
@@ -409,36 +543,50 @@ def get_codes(tree: HuffmanTree) -> dict[int, str]:
     >>> get_codes(HuffmanTree())
     {}
     """
-    return _get_codes_helper(tree)
-
+    d = {}
+    # each stack entry is a subtree together with its code. The right subtree
+    # is pushed first so that the leaves are visited from left to right.
+    stack = [(tree, '')]
+    while stack:
+        node, code = stack.pop()
+        if node.is_leaf():
+            # a leaf whose symbol is None is an empty tree, which has no codes.
+            if node.symbol is not None:
+                d[node.symbol] = code
+            continue
+        if node.right is not None:
+            stack.append((node.right, code + '1'))
+        if node.left is not None:
+            stack.append((node.left, code + '0'))
+    return d
+
+
+def get_int_codes(tree: HuffmanTree) -> dict[int, tuple[int, int]]:
+    """ Return a dictionary which maps symbols from the Huffman tree <tree>
+    to their codes, as (value, length) pairs, where value is the integer whose
+    last <length> bits are the code.
 
-def _get_codes_helper(tree: HuffmanTree, code: str = '') -> dict[int, str]:
-    """ Recursive helper function for get_codes. """
-    if tree.is_leaf():
-        d = {}
-        # if the tree is a leaf, and its symbol is None, then this is an empty
-        # tree, and so we return an empty dictionary.
-        if tree.symbol is None:
-            return d
-        # otherwise, we have reached a true base case where we are at a leaf
-        # with a symbol, and so we assign the <code> parameter to tree.symbol in
-        # d.
-        d[tree.symbol] = code
-        return d
-    else:
-        d = {}
-        # we recurse on the left subtree if it exists, and pass in the <code>
-        # parameter, plus a '0', since we are going left. The case where we
-        # recurse for self.right is analagous.
-        if tree.left is not None:
-            left_codes = _get_codes_helper(tree.left, code + '0')
-            for key in left_codes:
-                d.setdefault(key, left_codes[key])
-        if tree.right is not None:
-            right_codes = _get_codes_helper(tree.right, code + '1')
-            for key in right_codes:
-                d.setdefault(key, right_codes[key])
-        return d
+    >>> tree = HuffmanTree(None, HuffmanTree(3), \
+    HuffmanTree(None, HuffmanTree(2), HuffmanTree(7)))
+    >>> d = get_int_codes(tree)
+    >>> d == {3: (0b0, 1), 2: (0b10, 2), 7: (0b11, 2)}
+    True
+    >>> get_int_codes(HuffmanTree())
+    {}
+    """
+    d = {}
+    stack = [(tree, 0, 0)]
+    while stack:
+        node, value, length = stack.pop()
+        if node.is_leaf():
+            if node.symbol is not None:
+                d[node.symbol] = (value, length)
+            continue
+        if node.right is not None:
+            stack.append((node.right, (value << 1) | 1, length + 1))
+        if node.left is not None:
+            stack.append((node.left, value << 1, length + 1))
+    return d
 
 
 def number_nodes(tree: HuffmanTree) -> None:
@@ -456,29 +604,25 @@ def number_nodes(tree: HuffmanTree) -> None:
     >>> tree.number
     2
     """
-    _number_nodes_helper(tree, _Counter())
-
-
-def _number_nodes_helper(tree: HuffmanTree, counter: _Counter) -> None:
-    """ Recursive helper function for number_nodes. """
-    # we don't number leaves, unless the entire tree is empty
-    if tree.is_leaf():
-        if tree.symbol is None:
-            tree.number = 0
-        return
-    else:
-        # we recurse into the left and right trees, passing in (the mutable)
-        # <counter> parameter to keep track of which number we are currently at
-        # in the numbering stage.
-        if tree.left is not None:
-            _number_nodes_helper(tree.left, counter)
-        if tree.right is not None:
-            _number_nodes_helper(tree.right, counter)
-        # finally, after the numbering for the left and right subtrees is
-        # completed, number the root of this tree with the current count stored
-        # in <counter>, and increment counter.
-        tree.number = counter.count
-        counter.count += 1
+    count = 0
+    # each stack entry is a node together with whether its subtrees have
+    # already been numbered. Leaves are not numbered, unless the entire tree
+    # is empty.
+    stack = [(tree, False)]
+    while stack:
+        node, visited = stack.pop()
+        if node.is_leaf():
+            if node.symbol is None:
+                node.number = 0
+        elif visited:
+            node.number = count
+            count += 1
+        else:
+            stack.append((node, True))
+            if node.right is not None:
+                stack.append((node.right, False))
+            if node.left is not None:
+                stack.append((node.left, False))
 
 
 def avg_length(tree: HuffmanTree, freq_dict: dict[int, int]) -> float:
@@ -512,9 +656,13 @@ def avg_length(tree: HuffmanTree, freq_dict: dict[int, int]) -> float:
         return 0.0
 
 
-def compress_bytes(text: bytes, codes: dict[int, str]) -> bytes:
+def compress_bytes(text: bytes,
+                   codes: dict[int, str] | dict[int, tuple[int, int]]) \
+        -> bytes:
     """ Return the compressed form of <text>, using the mapping from <codes>
-    for each symbol.
+    for each symbol. <codes> may map symbols either to strings of bits (as
+    returned by get_codes) or to (value, length) pairs (as returned by
+    get_int_codes).
     >>> d = {0: "0", 1: "10", 2: "11"}
     >>> text = bytes([1, 2, 1, 0, 2])
     >>> result = compress_bytes(text, d)
@@ -526,6 +674,8 @@ def compress_bytes(text: bytes, codes: dict[int, str]) -> bytes:
     True
     >>> [byte_to_bits(byte) for byte in result]
     ['10111000']
+    >>> compress_bytes(text, {0: (0, 1), 1: (2, 2), 2: (3, 2)}) == result
+    True
     >>> compress_bytes(bytes([]), {}) == bytes([])
     True
     >>> compress_bytes(bytes([0]), {0: '00000001'}) == bytes([1])
@@ -533,33 +683,82 @@ def compress_bytes(text: bytes, codes: dict[int, str]) -> bytes:
     """
     if len(text) == 0:
         return bytes([])
-    code = []
-    to_be_converted = ''
-    length_of_to_be_converted = 0
-    # loop through every symbol in text, acquiring its code from the <codes>
-    # dictionary, and storing it in current_code. Then, we add every bit of
-    # current_code to the to_be_converted variable, until either (a) we exhaust
-    # all the contents of current_code, in which case we would move on to the
-    # code of the next symbol in <text>, or (b) the length of to_be_converted
-    # reaches 8, in which case we would convert it to bytes and append it to the
-    # code list and reset to_be_converted to be the empty string.
-    for symbol in text:
-        current_code = codes[symbol]
-        length_current_code = len(current_code)
-        for i in range(length_current_code):
-            if length_of_to_be_converted == 8:
-                code.append(bits_to_byte(to_be_converted))
-                to_be_converted = current_code[i]
-                length_of_to_be_converted = 1
-                continue
-            to_be_converted += current_code[i]
-            length_of_to_be_converted += 1
-    # to_be_converted has still not been converted yet (after the last
-    # iteration), so we must convert it.
-    if len(to_be_converted) != 0:
-        to_be_converted += '0' * (8 - length_of_to_be_converted)
-        code.append(bits_to_byte(to_be_converted))
-    return bytes(code)
+    packer = _BitPacker(codes)
+    return packer.pack(text) + packer.flush()
+
+
+class _BitPacker:
+    """ A Huffman encoder that packs codes into an integer accumulator.
+
+    Each symbol's code is shifted into the accumulator as a (value, length)
+    pair, and once it holds at least 64 bits, all of its complete bytes are
+    written out at once. Any bits that do not fill a byte are kept until the
+    next call to pack, or until flush pads them with zeros.
+
+    === Private Attributes ===
+    _table: the (value, length) pair of the code of every symbol, indexed by
+        symbol
+    _acc: the bits that have not been written out yet
+    _nbits: the number of bits in _acc
+    """
+    _table: list[Optional[tuple[int, int]]]
+    _acc: int
+    _nbits: int
+
+    def __init__(self,
+                 codes: dict[int, str] | dict[int, tuple[int, int]],
+                 start_bit: int = 0) -> None:
+        """ Initialize a new packer for the symbols and codes in <codes>. The
+        output starts with <start_bit> zero bits, where 0 <= start_bit < 8.
+        """
+        self._table = [None] * 256
+        for symbol in codes:
+            code = codes[symbol]
+            if isinstance(code, str):
+                code = (int(code, 2), len(code))
+            self._table[symbol] = code
+        self._acc = 0
+        self._nbits = start_bit
+
+    def pack(self, text: bytes) -> bytes:
+        """ Encode <text> and return all the complete bytes of the result that
+        are ready to be written out.
+
+        >>> packer = _BitPacker({0: "0", 1: "10", 2: "11"})
+        >>> list(packer.pack(bytes([1, 2, 1])))
+        []
+        >>> [byte_to_bits(byte) for byte in packer.flush()]
+        ['10111000']
+        """
+        table = self._table
+        acc, nbits = self._acc, self._nbits
+        out = bytearray()
+        for symbol in text:
+            value, length = table[symbol]
+            acc = (acc << length) | value
+            nbits += length
+            if nbits >= 64:
+                extra = nbits & 7
+                out += (acc >> extra).to_bytes((nbits - extra) >> 3, 'big')
+                acc &= (1 << extra) - 1
+                nbits = extra
+        # keep only the bits that still have not been written out.
+        extra = nbits & 7
+        if nbits > extra:
+            out += (acc >> extra).to_bytes((nbits - extra) >> 3, 'big')
+            acc &= (1 << extra) - 1
+        self._acc, self._nbits = acc, extra
+        return bytes(out)
+
+    def flush(self) -> bytes:
+        """ Return the remaining bits, padded with zeros to the right to make a
+        whole byte, or an empty bytes object if there are no remaining bits.
+        """
+        if self._nbits == 0:
+            return bytes([])
+        last = bytes([self._acc << (8 - self._nbits)])
+        self._acc, self._nbits = 0, 0
+        return last
 
 
 def tree_to_bytes(tree: HuffmanTree) -> bytes:
@@ -593,43 +792,256 @@ def tree_to_bytes(tree: HuffmanTree) -> bytes:
     # leaves do not have children, so they don't have a bytes representation.
     if tree.is_leaf():
         return bytes([])
-    else:
-        # recurse into the left and right trees (if they exist) and concatenate
-        # their bytes representation with ans
-        ans = bytes([])
-        if tree.left is not None:
-            ans += tree_to_bytes(tree.left)
-        if tree.right is not None:
-            ans += tree_to_bytes(tree.right)
-        # now we add the representation of the root node.
-        ans += bytes([int(not tree.left.is_leaf())])
-        ans += bytes([tree.left.symbol]) if tree.left.is_leaf() \
-            else bytes([tree.left.number])
-        ans += bytes([int(not tree.right.is_leaf())])
-        ans += bytes([tree.right.symbol]) if tree.right.is_leaf() \
-            else bytes([tree.right.number])
-        return ans
-
-
-def compress_file(in_file: str, out_file: str) -> None:
+    # the nodes are numbered in postorder, so each node's 4 bytes go at 4
+    # times its number, and the nodes can be visited in any order.
+    buf = bytearray(4 * (tree.number + 1))
+    stack = [tree]
+    while stack:
+        node = stack.pop()
+        i = 4 * node.number
+        for child in (node.left, node.right):
+            if child.is_leaf():
+                buf[i + 1] = child.symbol
+            else:
+                buf[i] = 1
+                buf[i + 1] = child.number
+                stack.append(child)
+            i += 2
+    return bytes(buf)
+
+
+def compress_file(in_file: str, out_file: str,
+                  chunk_size: int = CHUNK_SIZE,
+                  block_size: Optional[int] = None,
+                  parallel: bool = False,
+                  use_mmap: bool = False,
+                  canonical: bool = False,
+                  max_code_length: Optional[int] = None,
+                  model: Optional[str] = None) -> None:
     """ Compress contents of the file <in_file> and store results in <out_file>.
     Both <in_file> and <out_file> are string objects representing the names of
     the input and output files.
 
+    If <block_size> is None, a legacy (version 1) file is written, with a
+    single Huffman tree for the whole input (or a version 3 file, if the input
+    is too large for the size field of a version 1 file). The input is then
+    read twice, <chunk_size> bytes at a time: once to count the frequencies of
+    its bytes, and once to encode it into <out_file>. This way, neither the
+    input nor the output is ever held in memory in full. If the counts show
+    that the file would be no smaller than the input (as for input that is
+    already compressed), the input is copied into the stored blocks of a
+    version 2 file instead, without being encoded.
+
+    Otherwise, a version 2 file is written, in which every <block_size> bytes
+    of the input are compressed independently (see compress_block). If
+    <canonical> is True, a version 2 file is always written (with blocks of
+    BLOCK_SIZE bytes, if <block_size> is None), and its blocks store
+    canonical Huffman codes, which take less space than Huffman trees.
+
+    If <max_code_length> is not None, no code is longer than
+    <max_code_length> bits (see build_length_limited_tree).
+
+    If <model> is not None, a version 2 file is always written too, and its
+    blocks use the code of the static model named <model> instead of storing
+    their own (see compress_block), which suits small inputs best.
+
+    If <parallel> is True, the work is spread over the shared pool of worker
+    processes (see set_workers), with each worker handling <chunk_size> (or
+    <block_size>) bytes of the input at a time. The output is the same either
+    way.
+
+    If <use_mmap> is True, <in_file> is memory-mapped rather than read, and
+    its chunks are handed to the encoder as memoryview slices of the mapping,
+    without being copied.
+
     Precondition: The contents of the file <in_file> are not empty.
     """
-    with open(in_file, "rb") as f1:
-        text = f1.read()
-    freq = build_frequency_dict(text)
-    tree = build_huffman_tree(freq)
-    codes = get_codes(tree)
-    number_nodes(tree)
-    print("Bits per symbol:", avg_length(tree, freq))
-    result = (tree.num_nodes_to_bytes() + tree_to_bytes(tree)
-              + int32_to_bytes(len(text)))
-    result += compress_bytes(text, codes)
+    if (canonical or model is not None) and block_size is None:
+        block_size = BLOCK_SIZE
+    if model is not None:
+        _model_id(model)
+    if parallel:
+        _compress_file_parallel(in_file, out_file, chunk_size, block_size,
+                                use_mmap, canonical, max_code_length, model)
+        return
+    if block_size is not None:
+        _check_block_size(block_size)
+        _write_blocks_file(out_file, os.path.getsize(in_file), block_size,
+                           _compress_blocks(in_file, block_size, use_mmap,
+                                            canonical, max_code_length,
+                                            model))
+        return
+    freq = {}
+    size = 0
+    with _open_input(in_file, use_mmap) as f1:
+        for chunk in _read_chunks(f1, chunk_size):
+            _merge_frequencies(freq, _count_bytes(chunk))
+            size += len(chunk)
+    tree, codes = _prepare_tree(freq, max_code_length)
+    if _no_gain(tree, codes, freq, size):
+        _write_blocks_file(out_file, size, BLOCK_SIZE,
+                           _store_blocks(in_file, BLOCK_SIZE, use_mmap))
+        return
     with open(out_file, "wb") as f2:
-        f2.write(result)
+        f2.write(_stream_header(tree, size))
+        packer = _BitPacker(codes)
+        with _open_input(in_file, use_mmap) as f1:
+            for chunk in _read_chunks(f1, chunk_size):
+                f2.write(packer.pack(chunk))
+        f2.write(packer.flush())
+
+
+def _prepare_tree(freq: dict[int, int], max_code_length: Optional[int]) \
+        -> tuple[FlatHuffmanTree, dict[int, tuple[int, int]]]:
+    """ Return the Huffman tree for the frequencies of a whole input file in
+    <freq>, with codes of at most <max_code_length> bits (if it is not None),
+    and the codes of that tree, and report the average number of bits per
+    symbol. <freq> is given a dummy symbol if it needs one.
+
+    An empty input has an empty tree, which is written as the same legacy
+    header as in earlier versions.
+
+    >>> tree, codes = _prepare_tree({}, None)
+    Bits per symbol: 0.0
+    >>> list(_stream_header(tree, 0)), codes
+    ([1, 0, 0, 0, 0], {})
+    """
+    _add_dummy_symbol(freq)
+    if not freq:
+        tree = FlatHuffmanTree(array('H'), array('H'))
+    elif max_code_length is None:
+        tree = _build_flat_tree(freq)
+    else:
+        tree = FlatHuffmanTree.from_tree(
+            build_length_limited_tree(freq, max_code_length))
+        print("Bits per symbol lost to the length limit:",
+              length_limit_cost(freq, max_code_length))
+    codes = tree.codes()
+    print("Bits per symbol:", _average_length(freq, codes))
+    return tree, codes
+
+
+def _average_length(freq: dict[int, int],
+                    codes: dict[int, tuple[int, int]]) -> float:
+    """ Return the average number of bits per symbol of the text with the
+    symbol frequencies in <freq>, compressed with <codes> (like avg_length).
+
+    >>> _average_length({3: 2, 2: 7, 9: 1}, {3: (0, 2), 2: (1, 2), 9: (1, 1)})
+    1.9
+    """
+    total = sum(freq.values())
+    if total == 0:
+        return 0.0
+    return sum(freq[symbol] * codes[symbol][1] for symbol in codes) / total
+
+
+def _no_gain(tree: FlatHuffmanTree, codes: dict[int, tuple[int, int]],
+             freq: dict[int, int], size: int) -> bool:
+    """ Return whether compressing an input of <size> bytes, with the byte
+    frequencies in <freq>, as a single stream with the Huffman tree <tree>
+    and its <codes> would give a file that is no smaller than storing it in
+    a version 2 file of stored blocks.
+
+    Such an input is written as a version 2 file of stored blocks instead,
+    without encoding it at all.
+
+    >>> freq = {97: 1, 0: 0}
+    >>> tree = _build_flat_tree(freq)
+    >>> _no_gain(tree, tree.codes(), freq, 1)
+    False
+    """
+    return 0 < _stored_file_length(size, BLOCK_SIZE) \
+        <= len(_stream_header(tree, size)) + _encoded_length(freq, codes)
+
+
+def _stored_file_length(size: int, block_size: int) -> int:
+    """ Return the length of the version 2 file that _write_blocks_file
+    writes for <size> bytes in stored blocks of <block_size> bytes, or 0 if
+    <size> is 0.
+
+    >>> _stored_file_length(1, BLOCK_SIZE)
+    21
+    >>> _stored_file_length(3 * BLOCK_SIZE, BLOCK_SIZE) - 3 * BLOCK_SIZE
+    62
+    """
+    if size == 0:
+        return 0
+    num_blocks = -(-size // block_size)
+    length = len(_unindexed_header(block_size)) + 9 * num_blocks + size + 1
+    if num_blocks > 1:
+        # the total size, the number of blocks and the index
+        length += 8 + 4 + 4 * num_blocks
+    return length
+
+
+def _stream_header(tree: FlatHuffmanTree, size: int) -> bytes:
+    """ Return the header of a file that stores <size> bytes compressed as a
+    single stream with the Huffman tree <tree>: a version 1 header if <size>
+    fits in its 4-byte size field, or a version 3 header otherwise.
+
+    >>> tree = FlatHuffmanTree.from_tree(HuffmanTree(None, HuffmanTree(3), \
+    HuffmanTree(2)))
+    >>> list(_stream_header(tree, 300))
+    [1, 0, 3, 0, 2, 44, 1, 0, 0]
+    >>> list(_stream_header(tree, 1 << 32))
+    [0, 68, 74, 84, 3, 1, 0, 3, 0, 2, 0, 0, 0, 0, 1, 0, 0, 0]
+    """
+    if size <= _LEGACY_MAX_SIZE:
+        return tree.to_bytes() + int32_to_bytes(size)
+    return (MAGIC + bytes([VERSION_LARGE]) + tree.to_bytes()
+            + int64_to_bytes(size))
+
+
+@contextmanager
+def _open_input(in_file: str, use_mmap: bool) -> Iterator[BinaryIO]:
+    """ Open <in_file> for reading, as a read-only memory map of it if
+    <use_mmap> is True (and it is not empty, since empty files cannot be
+    mapped), or as a regular binary file otherwise. """
+    with open(in_file, "rb") as f:
+        if not use_mmap or os.fstat(f.fileno()).st_size == 0:
+            yield f
+        else:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                yield m
+
+
+@contextmanager
+def _open_piece(in_file: str, offset: int, length: int,
+                use_mmap: bool) -> Iterator[bytes | memoryview]:
+    """ Return the <length> bytes of <in_file> that start at <offset>, as a
+    memoryview of a memory map of <in_file> if <use_mmap> is True. The view
+    is only valid until the end of the with statement. """
+    with _open_input(in_file, use_mmap) as f:
+        if isinstance(f, mmap.mmap):
+            with memoryview(f) as view, \
+                    view[offset:offset + length] as piece:
+                yield piece
+        else:
+            f.seek(offset)
+            yield f.read(length)
+
+
+def _read_chunks(f: BinaryIO | mmap.mmap,
+                 chunk_size: int) -> Iterator[bytes | memoryview]:
+    """ Yield the rest of the contents of the binary file <f>, <chunk_size>
+    bytes at a time (the last chunk may be shorter).
+
+    If <f> is a memory map, the chunks are memoryview slices of it rather
+    than copies, and each is only valid until the next one is requested.
+    """
+    if isinstance(f, mmap.mmap):
+        with memoryview(f) as view:
+            position = f.tell()
+            while position < len(view):
+                with view[position:position + chunk_size] as chunk:
+                    position += len(chunk)
+                    f.seek(position)
+                    yield chunk
+        return
+    chunk = f.read(chunk_size)
+    while chunk:
+        yield chunk
+        chunk = f.read(chunk_size)
 
 # ====================
 # Functions for decompression
@@ -680,55 +1092,20 @@ HuffmanTree(None, HuffmanTree(10, None, None), HuffmanTree(12, None, None)))
     >>> lst = [ReadNode(0, 104, 0, 101), ReadNode(0, 119, 0, 114), \
     ReadNode(1, 0, 1, 1), ReadNode(0, 100, 0, 111), ReadNode(0, 108,\
     1, 3), ReadNode(1, 2, 1, 4)]
+    >>> generate_tree_postorder(lst, 5) == \
+    build_huffman_tree(build_frequency_dict(b'helloworld'))
+    True
     """
-    return _generate_tree_postorder_helper(node_lst, root_index, _Counter())
-
-
-def _generate_tree_postorder_helper(node_lst: list[ReadNode],
-                                    root_index: int, found: _Counter = None) \
-        -> HuffmanTree:
-    """ A recursive helper function for generate_tree_postorder
-
-    >>> lst = [ReadNode(0, 5, 0, 7), ReadNode(0, 10, 0, 12), \
-    ReadNode(1, 0, 1, 0)]
-    >>> generate_tree_postorder(lst, 2)
-    HuffmanTree(None, HuffmanTree(None, HuffmanTree(5, None, None), \
-HuffmanTree(7, None, None)), \
-HuffmanTree(None, HuffmanTree(10, None, None), HuffmanTree(12, None, None)))
-    >>> lst = [ReadNode(0, 104, 0, 101), ReadNode(0, 119, 0, 114), \
-    ReadNode(1, 0, 1, 1), ReadNode(0, 100, 0, 111), ReadNode(0, 108,\
-    1, 3), ReadNode(1, 2, 1, 4)]
-    """
-    l_type = node_lst[root_index].l_type
-    l_data = node_lst[root_index].l_data
-    r_type = node_lst[root_index].r_type
-    r_data = node_lst[root_index].r_data
-    tree = HuffmanTree()
-    # if the tree has both right and left subtrees as leaves, then this is our
-    # base case -- simply assign to leaves to the left and right subtrees.
-    if l_type == 0 and r_type == 0:
-        tree.left = HuffmanTree(l_data)
-        tree.right = HuffmanTree(r_data)
-    # otherwise, we follow the post ordering number procedure in reverse. In the
-    # numbering process, we would number the left tree from top up, then the
-    # right tree from top up, and then finally, the root. To work in reverse,
-    # the
-    else:
-        found_before = found.count
-        if r_type == 1:
-            found.count += 1
-            tree.right = _generate_tree_postorder_helper(node_lst, root_index
-                                                         - 1, found)
-        else:
-            tree.right = HuffmanTree(r_data)
-        difference = found.count - found_before
-        if l_type == 1:
-            found.count += 1
-            tree.left = _generate_tree_postorder_helper(node_lst, root_index - 1
-                                                        - difference, found)
-        else:
-            tree.left = HuffmanTree(l_data)
-    return tree
+    # in postorder, the internal children of a node are the two subtrees
+    # completed most recently before it (the right one last), so the nodes
+    # up to <root_index> are rebuilt in order with a stack of the subtrees
+    # that have no parent yet.
+    stack = []
+    for node in node_lst[:root_index + 1]:
+        right = stack.pop() if node.r_type == 1 else HuffmanTree(node.r_data)
+        left = stack.pop() if node.l_type == 1 else HuffmanTree(node.l_data)
+        stack.append(HuffmanTree(None, left, right))
+    return stack[-1]
 
 
 def decompress_bytes(tree: HuffmanTree, text: bytes, size: int) -> bytes:
@@ -739,84 +1116,1667 @@ def decompress_bytes(tree: HuffmanTree, text: bytes, size: int) -> bytes:
     >>> decompress_bytes(tree, \
              compress_bytes(b'helloworld', get_codes(tree)), len(b'helloworld'))
     b'helloworld'
+    >>> decompress_bytes(HuffmanTree(), bytes([]), 0)
+    b''
     """
-    # first, create a string, bits, that contains the bytes representation of
-    # entire <text> parameter.
-
-    # bits = "".join([byte_to_bits(byte) for byte in text])
-    codes = get_codes(tree)
-
-    # the code_to_byte dictionary will act as an "inverse dictionary" of codes,
-    # mapping codes to bytes instead of bytes to codes. The dictionary is built
-    # in the for loop below.
-    code_to_byte = {}
-    for byte in codes:
-        code_to_byte.setdefault(codes[byte], byte)
-    to_be_converted = []
-    current_code = ''
-    found = 0
-    # this loop follows the same description as the while loop below, but is
-    # more time-efficient.
-    for byte in text:
-        r, current_code, found = _decompress_bytes_helper((byte, code_to_byte,
-                                                           to_be_converted,
-                                                           current_code, found,
-                                                           size))
-        if r:
-            break
-
-    # now, begin a loop that ends when we have found <size> bytes (since there
-    # may be unwanted zeros at the end that we padded during compression). This
-    # loop will treat the bits local variable as a queue, looking at every bit
-    # from its beginning. Once it recognises a sequence of bits as a valid code
-    # as defined by code_to_byte, it will map it to a byte, and append that byte
-    # to the to_be_converted list, and then clear the current_code.
-
-    # # while loop version
-    # while found != size:
-    #     current_code += bits[i]
-    #     if current_code in code_to_byte:
-    #         to_be_converted.append(code_to_byte[current_code])
-    #         found += 1
-    #         current_code = ''
-    #     i += 1
-
-    return bytes(to_be_converted)
-
-
-def _decompress_bytes_helper(t: tuple[int, dict, list, str, int, int]) \
-        -> tuple[bool, str, int]:
-    """ A helper for the for loop in decompress bytes.
-     """
-    byte, code_to_byte, to_be_converted, current_code, found, size = t
-    for bit in byte_to_bits(byte):
-        current_code += bit
-        if current_code in code_to_byte:
-            to_be_converted.append(code_to_byte[current_code])
-            found += 1
-            current_code = ''
-            if found == size:
-                return True, current_code, found
-    return False, current_code, found
-
-
-def decompress_file(in_file: str, out_file: str) -> None:
+    if size == 0 or tree.is_leaf():
+        return bytes([])
+    flat = FlatHuffmanTree.from_tree(tree)
+    table = _DecodeTable(flat.left, flat.right)
+    decoded, _ = table.decode(text)
+    # the last byte of <text> may have been padded with zeros during
+    # compression, which can decode to extra symbols, so we only keep the first
+    # <size> of them.
+    return decoded[:size]
+
+
+class _DecodeTable:
+    """ A table-driven Huffman decoder that consumes a whole byte per step.
+
+    The decoder is a state machine whose states are the internal nodes of a
+    Huffman tree: the state is the node that the bits read so far have led to
+    (the root, if they formed a complete code). For every (state, byte) pair,
+    the table stores the symbols decoded by walking that byte's 8 bits from
+    that state, and the state the walk ends in. Entries are computed the
+    first time they are needed, so small inputs only pay for the entries
+    they use.
+
+    === Private Attributes ===
+    _left: the left child of every internal node (see FlatHuffmanTree)
+    _right: the right child of every internal node (see FlatHuffmanTree)
+    _emit: the symbols decoded for each (state, byte) pair, or None if that
+        entry has not been computed yet
+    _next: the state reached after each (state, byte) pair
+    root: the state of the root node
+    """
+    _left: Sequence[int]
+    _right: Sequence[int]
+    _emit: list[Optional[bytes]]
+    _next: list[int]
+    root: int
+
+    def __init__(self, left: Sequence[int], right: Sequence[int],
+                 root: Optional[int] = None) -> None:
+        """ Initialize an empty decode table for the internal nodes given by
+        <left> and <right>, whose root is the node at index <root> (or the
+        last node, if <root> is None).
+
+        Precondition: len(left) == len(right) > 0
+        """
+        self._left, self._right = left, right
+        self.root = len(left) - 1 if root is None else root
+        self._emit = [None] * (len(left) << 8)
+        self._next = [0] * (len(left) << 8)
+
+    def __len__(self) -> int:
+        """ Return the number of internal nodes of the tree of this table. """
+        return len(self._left)
+
+    def _fill(self, index: int) -> bytes:
+        """ Compute, store and return the table entry at <index>. """
+        left, right, root = self._left, self._right, self.root
+        node = index >> 8
+        byte = index & 0xFF
+        symbols = bytearray()
+        for shift in range(7, -1, -1):
+            child = right[node] if (byte >> shift) & 1 else left[node]
+            if child < 256:
+                symbols.append(child)
+                node = root
+            else:
+                node = child - 256
+        self._next[index] = node
+        self._emit[index] = bytes(symbols)
+        return self._emit[index]
+
+    def decode(self, text: bytes, state: Optional[int] = None) \
+            -> tuple[bytes, int]:
+        """ Decode every bit of <text>, starting from <state> (the root if it
+        is None). Return the decoded symbols and the state reached at the end
+        of <text>, which can be passed back in to continue decoding.
+
+        >>> table = _DecodeTable([3, 256], [2, 5])  # codes 3: 00, 2: 01, 5: 1
+        >>> list(table.decode(bytes([0b00011001]))[0])
+        [3, 2, 5, 3, 5]
+        >>> symbols, state = table.decode(bytes([0b10000000]), 0)
+        >>> list(symbols), state
+        ([2, 3, 3, 3], 0)
+        """
+        if state is None:
+            state = self.root
+        emit, nxt, fill = self._emit, self._next, self._fill
+        out = bytearray()
+        for byte in text:
+            index = (state << 8) | byte
+            symbols = emit[index]
+            if symbols is None:
+                symbols = fill(index)
+            out += symbols
+            state = nxt[index]
+        return bytes(out), state
+
+
+class _DecodeTableCache:
+    """ A cache of decode tables by the headers they were built from, which
+    drops the least recently used tables once their trees have more than a
+    given number of nodes in total. It can be used from several threads.
+
+    === Private Attributes ===
+    _max_nodes: the largest total number of nodes of the cached tables
+    _tables: the cached tables, from the least to the most recently used
+    _nodes: the total number of nodes of the cached tables
+    _lock: the lock that is taken before using _tables and _nodes
+
+    >>> cache = _DecodeTableCache(3)
+    >>> build = lambda header: _DecodeTable([3, 256], [2, 5])
+    >>> table = cache.get(b'a', build)
+    >>> cache.get(b'a', build) is table
+    True
+    >>> _ = cache.get(b'b', build)  # two tables of 2 nodes do not fit
+    >>> cache.get(b'a', build) is table
+    False
+    """
+    _max_nodes: int
+    _tables: OrderedDict[bytes, _DecodeTable]
+    _nodes: int
+    _lock: threading.Lock
+
+    def __init__(self, max_nodes: int) -> None:
+        """ Initialize an empty cache of tables with at most <max_nodes>
+        nodes in total. """
+        self._max_nodes = max_nodes
+        self._tables = OrderedDict()
+        self._nodes = 0
+        self._lock = threading.Lock()
+
+    def get(self, header: bytes,
+            build: Callable[[bytes], _DecodeTable]) -> _DecodeTable:
+        """ Return the table for <header>, calling <build> with <header> to
+        make it if it is not cached. """
+        with self._lock:
+            table = self._tables.get(header)
+            if table is not None:
+                self._tables.move_to_end(header)
+                return table
+        table = build(header)
+        with self._lock:
+            if header not in self._tables:
+                self._tables[header] = table
+                self._nodes += len(table)
+                while self._nodes > self._max_nodes and len(self._tables) > 1:
+                    _, old = self._tables.popitem(last=False)
+                    self._nodes -= len(old)
+        return table
+
+
+_tree_tables = _DecodeTableCache(_DECODE_TABLE_CACHE_NODES)
+_lengths_tables = _DecodeTableCache(_DECODE_TABLE_CACHE_NODES)
+
+
+def _tree_decode_table(nodes: bytes) -> _DecodeTable:
+    """ Return the decode table for the tree stored in <nodes>, the bytes of
+    its nodes in postorder (as written by tree_to_bytes).
+
+    The tables for recently seen trees are cached, and are shared by every
+    file that has the same tree, so neither the tree nor its table is built
+    again.
+
+    >>> nodes = bytes([0, 104, 0, 101, 0, 111, 0, 108, 1, 0, 1, 1])
+    >>> _tree_decode_table(nodes) is _tree_decode_table(nodes)
+    True
+    """
+    return _tree_tables.get(nodes, _build_tree_decode_table)
+
+
+def _build_tree_decode_table(nodes: bytes) -> _DecodeTable:
+    """ Return a new decode table for the tree stored in <nodes>. """
+    flat = parse_tree(nodes)
+    return _DecodeTable(flat.left, flat.right)
+
+
+def parse_tree(nodes: bytes) -> FlatHuffmanTree:
+    """ Return the tree stored in <nodes>, the bytes of its nodes in postorder
+    (as written by tree_to_bytes), as a FlatHuffmanTree.
+
+    <nodes> may be any bytes-like object, such as a memoryview of a file, and
+    its records are unpacked in place without building a node object for
+    each of them.
+
+    Raise DjertyFileError if <nodes> is not a valid tree: its length is not a
+    positive multiple of 4, a node has a child type other than 0 or 1, a node
+    refers to a node other than the root of the subtree that comes right
+    before it, or not every node is part of the tree of the last node.
+
+    >>> flat = parse_tree(bytes([0, 104, 0, 101, 0, 111, 0, 108, 1, 0, 1, 1]))
+    >>> list(flat.left), list(flat.right)
+    ([104, 111, 256], [101, 108, 257])
+    >>> try:
+    ...     parse_tree(bytes([0, 104, 0, 101, 1, 1, 0, 108]))
+    ... except DjertyFileError as error:
+    ...     print(error.reason)
+    it refers to a tree node that does not exist
+    >>> try:
+    ...     parse_tree(bytes([0, 104, 0, 101, 0, 111, 0, 108]))
+    ... except DjertyFileError as error:
+    ...     print(error.reason)
+    its tree has nodes that are not connected
+    """
+    if len(nodes) == 0 or len(nodes) % 4 != 0:
+        raise DjertyFileError('its tree is truncated')
+    left, right = array('H'), array('H')
+    # the indices of the roots of the subtrees that no node refers to yet,
+    # which postorder lets the next internal children be taken from
+    roots = []
+    for index, (l_type, l_data, r_type, r_data) in \
+            enumerate(struct.iter_unpack('4B', nodes)):
+        if l_type > 1 or r_type > 1:
+            raise DjertyFileError('its tree has a node of an unknown type')
+        # the right subtree is the one that was completed last
+        if r_type == 1:
+            if not roots or roots[-1] != r_data:
+                raise DjertyFileError('it refers to a tree node that does '
+                                      'not exist')
+            r_data = 256 + roots.pop()
+        if l_type == 1:
+            if not roots or roots[-1] != l_data:
+                raise DjertyFileError('it refers to a tree node that does '
+                                      'not exist')
+            l_data = 256 + roots.pop()
+        left.append(l_data)
+        right.append(r_data)
+        roots.append(index)
+    if len(roots) != 1:
+        raise DjertyFileError('its tree has nodes that are not connected')
+    return FlatHuffmanTree(left, right)
+
+
+def decompress_file(in_file: str, out_file: str,
+                    chunk_size: int = CHUNK_SIZE,
+                    parallel: bool = False,
+                    use_mmap: bool = False) -> None:
     """ Decompress contents of <in_file> and store results in <out_file>.
     Both <in_file> and <out_file> are string objects representing the names of
     the input and output files.
 
-    Precondition: The contents of the file <in_file> are not empty.
+    Legacy (version 1), version 2 and version 3 files can be decompressed.
+    The compressed text of a version 1 or 3 file is read <chunk_size> bytes
+    at a time, and each chunk is decoded and written to <out_file> before the
+    next one is read; the blocks of a version 2 file are decoded one at a
+    time, or, if <parallel> is True, several at a time in the shared pool of
+    worker processes (see set_workers).
+
+    If <use_mmap> is True, <in_file> is memory-mapped rather than read, and
+    the compressed text is decoded straight from the mapping.
+
+    Raise DjertyFileError if <in_file> is not a valid .djerty file.
     """
-    with open(in_file, "rb") as f:
-        num_nodes = f.read(1)[0]
-        buf = f.read(num_nodes * 4)
-        node_lst = bytes_to_nodes(buf)
-        # use generate_tree_general or generate_tree_postorder here
-        tree = generate_tree_postorder(node_lst, num_nodes - 1)
-        size = bytes_to_int(f.read(4))
+    with _open_input(in_file, use_mmap) as f:
+        version = _read_version(f)
         with open(out_file, "wb") as g:
-            text = f.read()
-            g.write(decompress_bytes(tree, text, size))
+            if version == 1:
+                _decompress_legacy(f, g, chunk_size)
+            elif version == VERSION_LARGE:
+                _decompress_legacy(f, g, chunk_size, 8)
+            elif parallel:
+                _decompress_blocks_parallel(in_file, f, g, use_mmap)
+            else:
+                _decompress_blocks(f, g)
+
+
+def _read_version(f: BinaryIO) -> int:
+    """ Return the version of the compressed file <f>, which is open at its
+    start, and move past the magic bytes and version of a versioned file.
+
+    Raise DjertyFileError if the version cannot be decompressed.
+    """
+    if f.read(1) != MAGIC[:1]:
+        # this is a legacy file, whose first byte is part of its tree header.
+        f.seek(0)
+        return 1
+    head = f.read(len(MAGIC))
+    if len(head) != len(MAGIC) or head[:-1] != MAGIC[1:]:
+        raise DjertyFileError('it does not start with a valid header')
+    if head[-1] not in (VERSION_BLOCKS, VERSION_LARGE):
+        raise DjertyFileError(f'its version ({head[-1]}) is not supported')
+    return head[-1]
+
+
+def _decompress_legacy(f: BinaryIO, g: BinaryIO, chunk_size: int,
+                       size_length: int = 4) -> None:
+    """ Decompress the legacy (version 1) file <f> into <g>, reading
+    <chunk_size> bytes of compressed text at a time. A version 3 file, which
+    is open right after its version byte, is decompressed if <size_length> is
+    8 instead of 4.
+
+    Raise DjertyFileError if <f> ends before all of its bytes have been
+    decompressed.
+    """
+    head = f.read(1)
+    if not head:
+        raise DjertyFileError('it is empty')
+    num_nodes = head[0]
+    buf = f.read(num_nodes * 4)
+    if len(buf) != num_nodes * 4:
+        raise DjertyFileError('its tree is truncated')
+    table = _tree_decode_table(buf)
+    size_bytes = f.read(size_length)
+    if len(size_bytes) != size_length:
+        if head + buf + size_bytes == _LEGACY_EMPTY_FILE:
+            # an empty input was written with an empty tree, whose four bytes
+            # of size were read as its tree.
+            return
+        raise DjertyFileError('it ends unexpectedly')
+    size = bytes_to_int(size_bytes)
+    if size != 0:
+        _decompress_stream(table, f, g, size, chunk_size)
+
+
+def _decompress_stream(table: _DecodeTable, f: BinaryIO, g: BinaryIO,
+                       size: int, chunk_size: int) -> None:
+    """ Use <table> to decompress <size> bytes from the compressed text read
+    from <f>, <chunk_size> bytes at a time, and write them to <g>. The decoder
+    state is carried from one chunk to the next, so codes may span chunks.
+
+    Raise DjertyFileError if <f> ends before <size> bytes are decompressed.
+    """
+    state = table.root
+    for chunk in _read_chunks(f, chunk_size):
+        decoded, state = table.decode(chunk, state)
+        if len(decoded) >= size:
+            g.write(decoded[:size])
+            return
+        g.write(decoded)
+        size -= len(decoded)
+    raise DjertyFileError('it ends unexpectedly')
+
+
+# ====================
+# Functions for canonical Huffman codes
+#
+# In a canonical Huffman code, the codes are determined by their lengths
+# alone: the symbols are sorted by the length of their codes (and then by
+# the symbols themselves), and each gets the next code of its length in
+# counting order. Only the lengths have to be stored, as:
+#   - the number of symbols minus one (1 byte)
+#   - the length of the longest code (1 byte)
+#   - the number of codes of each length from 1 up to (but not including) the
+#     longest (1 byte each); the rest of the codes have the longest length
+#   - the symbols, in the order they are given codes (1 byte each)
+
+
+def get_code_lengths(tree: HuffmanTree) -> dict[int, int]:
+    """ Return a dictionary which maps symbols from the Huffman tree <tree>
+    to the lengths of their codes.
+
+    >>> tree = HuffmanTree(None, HuffmanTree(3), \
+    HuffmanTree(None, HuffmanTree(2), HuffmanTree(7)))
+    >>> get_code_lengths(tree) == {3: 1, 2: 2, 7: 2}
+    True
+    """
+    codes = get_int_codes(tree)
+    return {symbol: codes[symbol][1] for symbol in codes}
+
+
+def canonical_codes(lengths: dict[int, int]) -> dict[int, tuple[int, int]]:
+    """ Return the canonical Huffman codes, as (value, length) pairs, for the
+    symbols and code lengths in <lengths>. The codes are returned in the
+    order they are given out.
+
+    >>> canonical_codes({7: 2, 3: 1, 2: 2})
+    {3: (0, 1), 2: (2, 2), 7: (3, 2)}
+    >>> canonical_codes({65: 3, 66: 3, 67: 2, 68: 2, 69: 2}) == \
+    {67: (0b00, 2), 68: (0b01, 2), 69: (0b10, 2), 65: (0b110, 3), \
+    66: (0b111, 3)}
+    True
+    """
+    codes = {}
+    code = 0
+    previous_length = 0
+    for symbol in sorted(lengths, key=lambda s: (lengths[s], s)):
+        code <<= lengths[symbol] - previous_length
+        previous_length = lengths[symbol]
+        codes[symbol] = (code, previous_length)
+        code += 1
+    return codes
+
+
+def lengths_to_bytes(lengths: dict[int, int]) -> bytes:
+    """ Return the bytes representation of the canonical Huffman code with
+    the code lengths in <lengths>.
+
+    Precondition: <lengths> has between 2 and 256 symbols, and is the code
+    lengths of a Huffman tree.
+
+    >>> list(lengths_to_bytes({7: 2, 3: 1, 2: 2}))
+    [2, 2, 1, 3, 2, 7]
+    """
+    order = list(canonical_codes(lengths))
+    max_length = lengths[order[-1]]
+    counts = [0] * max_length
+    for symbol in order:
+        counts[lengths[symbol] - 1] += 1
+    return bytes([len(order) - 1, max_length] + counts[:-1] + order)
+
+
+def bytes_to_lengths(buf: bytes, start: int = 0) -> tuple[dict[int, int], int]:
+    """ Return the code lengths of the canonical Huffman code whose bytes
+    representation starts at index <start> of <buf>, and the index right
+    after that representation.
+
+    Raise DjertyFileError if the representation is not that of a complete
+    prefix code.
+
+    >>> bytes_to_lengths(bytes([9, 2, 2, 1, 3, 2, 7, 42]), 1)
+    ({3: 1, 2: 2, 7: 2}, 7)
+    >>> try:
+    ...     bytes_to_lengths(bytes([2, 2, 2, 3, 2, 7]))
+    ... except DjertyFileError as error:
+    ...     print(error.reason)
+    the code lengths of one of its blocks are invalid
+    """
+    if len(buf) < start + 2:
+        raise DjertyFileError('the code lengths of one of its blocks are '
+                              'truncated')
+    num_symbols = buf[start] + 1
+    max_length = buf[start + 1]
+    end = start + 1 + max_length + num_symbols
+    if max_length == 0 or len(buf) < end:
+        raise DjertyFileError('the code lengths of one of its blocks are '
+                              'truncated')
+    counts = list(buf[start + 2:start + 1 + max_length])
+    counts.append(num_symbols - sum(counts))
+    symbols = buf[start + 1 + max_length:end]
+    # the code is a complete prefix code iff the codes of every length use up
+    # exactly all of the code space (this is the Kraft equality).
+    space = sum(count << (max_length - length)
+                for length, count in enumerate(counts, 1))
+    if (counts[-1] <= 0 or space != 1 << max_length
+            or len(set(symbols)) != num_symbols):
+        raise DjertyFileError('the code lengths of one of its blocks are '
+                              'invalid')
+    lengths = {}
+    i = 0
+    for length, count in enumerate(counts, 1):
+        for symbol in symbols[i:i + count]:
+            lengths[symbol] = length
+        i += count
+    return lengths, end
+
+
+def _decode_table_from_lengths(lengths: dict[int, int]) -> _DecodeTable:
+    """ Return a decode table for the canonical Huffman code with the code
+    lengths in <lengths>, built without making a HuffmanTree.
+
+    Precondition: <lengths> is the code lengths of a complete prefix code.
+
+    >>> table = _decode_table_from_lengths({7: 2, 3: 1, 2: 2})
+    >>> list(table.decode(bytes([0b01011000]))[0])
+    [3, 2, 7, 3, 3, 3]
+    """
+    # the internal nodes are created as the codes are inserted, with the root
+    # at index 0; -1 marks a child that has not been set yet.
+    left, right = [-1], [-1]
+    codes = canonical_codes(lengths)
+    for symbol in codes:
+        value, length = codes[symbol]
+        node = 0
+        for shift in range(length - 1, 0, -1):
+            children = right if (value >> shift) & 1 else left
+            if children[node] == -1:
+                children[node] = 256 + len(left)
+                left.append(-1)
+                right.append(-1)
+            node = children[node] - 256
+        (right if value & 1 else left)[node] = symbol
+    return _DecodeTable(left, right, 0)
+
+
+def _canonical_decode_table(block: bytes, start: int) \
+        -> tuple[_DecodeTable, int]:
+    """ Return the decode table for the code lengths stored at index <start>
+    of <block> (see lengths_to_bytes), and the index right after them.
+
+    Like _tree_decode_table, the tables for recently seen code lengths are
+    cached.
+
+    Raise DjertyFileError if the code lengths are not valid.
+    """
+    _, end = bytes_to_lengths(block, start)
+    return _cached_lengths_table(bytes(block[start:end])), end
+
+
+def _cached_lengths_table(header: bytes) -> _DecodeTable:
+    """ Return the decode table for the code lengths stored in <header>. """
+    return _lengths_tables.get(
+        header,
+        lambda key: _decode_table_from_lengths(bytes_to_lengths(key, 0)[0]))
+
+
+# ====================
+# Functions for length-limited Huffman codes
+#
+# A Huffman code for symbols with very skewed frequencies can have codes of
+# up to 255 bits. Limiting the length of the codes costs a little
+# compression, but keeps decode tables small and lets codes fit in machine
+# integers. The lengths are computed with the package-merge algorithm, which
+# finds the optimal code lengths under the limit.
+
+
+def limited_code_lengths(freq_dict: dict[int, int],
+                         max_length: int) -> dict[int, int]:
+    """ Return the lengths of the optimal prefix code for the symbols and
+    frequencies in <freq_dict> in which no code is longer than <max_length>
+    bits.
+
+    Precondition: 2 <= len(freq_dict) <= 2 ** max_length
+
+    >>> freq = {0: 1, 1: 1, 2: 2, 3: 4, 4: 8}
+    >>> limited_code_lengths(freq, 4) == {0: 4, 1: 4, 2: 3, 3: 2, 4: 1}
+    True
+    >>> limited_code_lengths(freq, 3) == {0: 3, 1: 3, 2: 3, 3: 3, 4: 1}
+    True
+    """
+    symbols = sorted(freq_dict, key=lambda s: (freq_dict[s], s))
+    leaves = [(freq_dict[symbol], [symbol]) for symbol in symbols]
+    # each item is a (weight, symbols) pair, where symbols lists (with
+    # repeats) the leaves that the item is made of. Pairing up the items of
+    # one level into packages and merging them with the leaves gives the items
+    # of the next level.
+    items = leaves
+    for _ in range(max_length - 1):
+        packages = [(items[i][0] + items[i + 1][0],
+                     items[i][1] + items[i + 1][1])
+                    for i in range(0, len(items) - 1, 2)]
+        items = list(heapq.merge(leaves, packages, key=lambda item: item[0]))
+    # every time a symbol appears in the 2n - 2 cheapest items, its code gets
+    # one bit longer.
+    lengths = dict.fromkeys(symbols, 0)
+    for _, item_symbols in items[:2 * len(symbols) - 2]:
+        for symbol in item_symbols:
+            lengths[symbol] += 1
+    return lengths
+
+
+def tree_from_lengths(lengths: dict[int, int]) -> HuffmanTree:
+    """ Return the Huffman tree of the canonical Huffman code with the code
+    lengths in <lengths>.
+
+    Precondition: <lengths> is the code lengths of a complete prefix code.
+
+    >>> tree_from_lengths({7: 2, 3: 1, 2: 2})
+    HuffmanTree(None, HuffmanTree(3, None, None), \
+HuffmanTree(None, HuffmanTree(2, None, None), HuffmanTree(7, None, None)))
+    """
+    root = HuffmanTree()
+    codes = canonical_codes(lengths)
+    for symbol in codes:
+        value, length = codes[symbol]
+        node = root
+        for shift in range(length - 1, -1, -1):
+            if (value >> shift) & 1:
+                if node.right is None:
+                    node.right = HuffmanTree()
+                node = node.right
+            else:
+                if node.left is None:
+                    node.left = HuffmanTree()
+                node = node.left
+        node.symbol = symbol
+    return root
+
+
+def build_length_limited_tree(freq_dict: dict[int, int],
+                              max_length: int) -> HuffmanTree:
+    """ Return a Huffman tree for the frequency dictionary <freq_dict> in
+    which no code is longer than <max_length> bits. This is the same tree as
+    build_huffman_tree returns if none of its codes are too long.
+
+    Precondition: 1 <= len(freq_dict) <= 2 ** max_length
+
+    >>> freq = {0: 1, 1: 1, 2: 2, 3: 4, 4: 8}
+    >>> build_length_limited_tree(freq, 4) == build_huffman_tree(freq)
+    True
+    >>> codes = get_codes(build_length_limited_tree(freq, 3))
+    >>> max(len(code) for code in codes.values())
+    3
+    """
+    if len(freq_dict) > 1 << max_length:
+        raise ValueError(f'{len(freq_dict)} symbols do not fit in codes of '
+                         f'at most {max_length} bits')
+    tree = build_huffman_tree(freq_dict)
+    lengths = get_code_lengths(tree)
+    if max(lengths.values(), default=0) <= max_length:
+        return tree
+    # the unlimited tree gives every symbol a code, including the dummy symbol
+    # of a single-symbol dictionary, so its symbols are the ones to limit.
+    return tree_from_lengths(limited_code_lengths(
+        {symbol: freq_dict.get(symbol, 0) for symbol in lengths},
+        max_length))
+
+
+def length_limit_cost(freq_dict: dict[int, int], max_length: int) -> float:
+    """ Return how many more bits per symbol, on average, the text with the
+    frequencies in <freq_dict> takes to compress when codes are limited to
+    <max_length> bits than when they are not limited.
+
+    >>> freq = {0: 1, 1: 1, 2: 2, 3: 4, 4: 8}
+    >>> length_limit_cost(freq, 4)
+    0.0
+    >>> length_limit_cost(freq, 3)  # (3 + 3 + 6 + 12 + 8 - 30) / 16
+    0.125
+    """
+    return (avg_length(build_length_limited_tree(freq_dict, max_length),
+                       freq_dict)
+            - avg_length(build_huffman_tree(freq_dict), freq_dict))
+
+
+# ====================
+# Functions for static models
+#
+# A static model is a frequency for every one of the 256 possible bytes,
+# trained ahead of time on a corpus of typical inputs (see train_model and
+# huffman_compressor/models.py). Its code is built from those frequencies, so
+# a block compressed with a model only has to store the model's id instead
+# of its own Huffman code, which saves a lot of space for small inputs.
+
+# the longest code of a model's code. Every byte has a code, however rare it
+# is in the corpus, so the rarest ones are kept from getting very long codes.
+MODEL_MAX_CODE_LENGTH = 16
+
+# the total that the frequencies of a model add up to (roughly)
+MODEL_SCALE = 1 << 16
+
+
+def train_model(corpus: Iterable[bytes]) -> tuple[int, ...]:
+    """ Return the frequencies of a static model trained on the texts in
+    <corpus>, as a tuple whose item at index i is the frequency of byte i.
+
+    The frequencies are scaled to add up to about MODEL_SCALE, and every
+    byte has a frequency of at least 1, so that every input can be
+    compressed with the model.
+
+    >>> model = train_model([b'aab', b'a'])
+    >>> len(model), model[ord('a')], model[ord('b')], model[ord('c')]
+    (256, 49153, 16385, 1)
+    """
+    freq = {}
+    total = 0
+    for text in corpus:
+        _merge_frequencies(freq, build_frequency_dict(text))
+        total += len(text)
+    return tuple(1 + freq.get(byte, 0) * MODEL_SCALE // max(total, 1)
+                 for byte in range(256))
+
+
+def _model_id(model: str) -> int:
+    """ Return the id of the model named <model>.
+
+    Raise ValueError if there is no model named <model>.
+    """
+    if model not in MODELS:
+        raise ValueError(f'there is no model named {model!r}')
+    return MODEL_NAMES.index(model)
+
+
+@functools.lru_cache(maxsize=None)
+def _model_lengths(model_id: int) -> dict[int, int]:
+    """ Return the code lengths of the model with id <model_id>. """
+    model = MODELS[MODEL_NAMES[model_id]]
+    return limited_code_lengths(dict(enumerate(model)), MODEL_MAX_CODE_LENGTH)
+
+
+@functools.lru_cache(maxsize=None)
+def _model_codes(model_id: int) -> dict[int, tuple[int, int]]:
+    """ Return the codes of the model with id <model_id>. """
+    return canonical_codes(_model_lengths(model_id))
+
+
+@functools.lru_cache(maxsize=None)
+def _model_decode_table(model_id: int) -> _DecodeTable:
+    """ Return the decode table of the model with id <model_id>. """
+    return _decode_table_from_lengths(_model_lengths(model_id))
+
+
+# ====================
+# Functions for estimating compressed size
+#
+# The entropy of a text's byte frequencies is the smallest average number of
+# bits per byte that any code for those bytes can achieve, and a Huffman code
+# always comes within one bit of it (and usually much closer). It is quick to
+# compute, with no tree needed, and the frequencies can be counted from a
+# sample of the input rather than the whole of it, so it can be used to decide
+# how to compress an input before doing any of the work.
+
+# the number and size of the pieces of an input that sample_frequencies counts
+SAMPLE_COUNT = 16
+SAMPLE_SIZE = 1 << 14
+
+# the ways that choose_strategy can choose to compress an input
+STRATEGY_HUFFMAN = 'huffman'
+STRATEGY_STORED = 'stored'
+STRATEGY_PARALLEL = 'parallel'
+
+# the entropy (in bits per byte) at and above which an input is stored rather
+# than compressed, since Huffman coding would gain almost nothing
+STORE_MIN_ENTROPY = 7.9
+
+# the size of the smallest input that is worth compressing in parallel
+PARALLEL_MIN_SIZE = 1 << 25
+
+
+def entropy(freq_dict: dict[int, int]) -> float:
+    """ Return the entropy, in bits per symbol, of the symbols and frequencies
+    in <freq_dict>.
+
+    >>> entropy({3: 2, 2: 2, 9: 4})
+    1.5
+    >>> entropy({65: 10})
+    0.0
+    >>> entropy({})
+    0.0
+    """
+    total = sum(freq_dict.values())
+    if total == 0:
+        return 0.0
+    return max(0.0, math.log2(total) - sum(
+        f * math.log2(f) for f in freq_dict.values() if f) / total)
+
+
+def estimate_size(freq_dict: dict[int, int]) -> int:
+    """ Return an estimate of the number of bytes that the text with the byte
+    frequencies in <freq_dict> compresses to, including its Huffman tree,
+    without building the tree.
+
+    >>> estimate_size({3: 200, 2: 200, 9: 400})
+    163
+    """
+    total = sum(freq_dict.values())
+    header = 1 + 4 * max(len(freq_dict) - 1, 1) + 4
+    return header + round(entropy(freq_dict) * total / 8)
+
+
+def sample_frequencies(f: BinaryIO, count: int = SAMPLE_COUNT,
+                       sample_size: int = SAMPLE_SIZE) -> dict[int, int]:
+    """ Return the byte frequencies of <count> pieces of <sample_size> bytes,
+    spread evenly over the seekable binary file <f>, or of the whole of <f>
+    if it is no larger than that. <f> is left where it was.
+
+    >>> import io
+    >>> f = io.BytesIO(b'a' * 100 + b'b' * 100)
+    >>> sample_frequencies(f, count=2, sample_size=10) == {97: 10, 98: 10}
+    True
+    >>> f.tell()
+    0
+    """
+    start = f.tell()
+    size = f.seek(0, os.SEEK_END) - start
+    try:
+        if size <= count * sample_size:
+            f.seek(start)
+            sample = f.read()
+        else:
+            step = (size - sample_size) // max(count - 1, 1)
+            pieces = []
+            for i in range(count):
+                f.seek(start + i * step)
+                pieces.append(f.read(sample_size))
+            sample = b''.join(pieces)
+    finally:
+        f.seek(start)
+    # unlike _count_bytes, the order of the symbols does not matter here.
+    if numpy is None:
+        return dict(Counter(sample))
+    counts = numpy.bincount(numpy.frombuffer(sample, dtype=numpy.uint8),
+                            minlength=256).tolist()
+    return {byte: counts[byte] for byte in range(256) if counts[byte]}
+
+
+def choose_strategy(freq_dict: dict[int, int], size: int) -> str:
+    """ Return how an input of <size> bytes whose byte frequencies (or those
+    of a sample of it) are in <freq_dict> should be compressed:
+
+    - STRATEGY_STORED, if its entropy is so high that compressing it would
+      gain next to nothing, so it should be stored uncompressed
+    - STRATEGY_PARALLEL, if it is large enough to be worth compressing in
+      blocks in parallel, and there is more than one worker process
+    - STRATEGY_HUFFMAN otherwise
+
+    >>> choose_strategy(dict.fromkeys(range(256), 1), 1000)
+    'stored'
+    >>> choose_strategy({97: 900, 98: 100}, 1000)
+    'huffman'
+    """
+    if entropy(freq_dict) >= STORE_MIN_ENTROPY:
+        return STRATEGY_STORED
+    if size >= PARALLEL_MIN_SIZE and _num_workers() > 1:
+        return STRATEGY_PARALLEL
+    return STRATEGY_HUFFMAN
+
+
+# ====================
+# Functions for the block (version 2) file format
+#
+# A version 2 file consists of:
+#   - MAGIC and the version byte (2)
+#   - a flags byte
+#   - the block size (4 bytes)
+#   - if the file is indexed (its flags include _FLAG_INDEXED): the size of
+#     the original file (8 bytes), the number of blocks (4 bytes), and the
+#     length of every block (4 bytes each), which give the position of every
+#     block without having to read the ones before it
+#   - the blocks, each consisting of its type (1 byte), the number of bytes it
+#     decompresses to (4 bytes), the length of its payload (4 bytes) and its
+#     payload
+#   - a single _BLOCK_END byte
+#
+# The payload of a _BLOCK_TREE block is the number of nodes of its Huffman
+# tree, the bytes representation of that tree, and the compressed text. The
+# payload of a _BLOCK_CANONICAL block is the bytes representation of its
+# canonical Huffman code (see lengths_to_bytes), and the compressed text.
+#
+# The payload of a _BLOCK_MODEL block is the id of the static model whose code
+# it uses (its index in MODEL_NAMES), and the compressed text.
+#
+# The payload of a _BLOCK_STORED block is the text itself, uncompressed. A
+# block is stored whenever compressing it would not make it any smaller.
+#
+# Every block is compressed independently, with its own Huffman code (or a
+# model's), so blocks can be compressed and decompressed in any order.
+# All numbers are little-endian.
+
+
+def compress_block(text: bytes, canonical: bool = False,
+                   max_code_length: Optional[int] = None,
+                   model: Optional[str] = None) -> bytes:
+    """ Return the block of a version 2 file that stores <text>, using a
+    canonical Huffman code if <canonical> is True, or a Huffman tree
+    otherwise, with codes of at most <max_code_length> bits if it is not
+    None.
+
+    If <model> is not None, the code of the static model named <model> (see
+    MODEL_NAMES) is used instead, so the block stores no code at all, only
+    the id of the model.
+
+    If the compressed payload would be no smaller than <text>, which is
+    known from the code lengths before any text is encoded, <text> is
+    stored as it is instead.
+
+    Precondition: 0 < len(text) <= MAX_BLOCK_SIZE
+
+    >>> text = b'abracadabra' * 4
+    >>> block = compress_block(text)
+    >>> block[0] == _BLOCK_TREE, bytes_to_int(block[1:5]), len(block)
+    (True, 44, 38)
+    >>> decompress_block(block) == text
+    True
+    >>> block = compress_block(text, canonical=True)
+    >>> block[0] == _BLOCK_CANONICAL, len(block)
+    (True, 30)
+    >>> decompress_block(block) == text
+    True
+    >>> block = compress_block(b'helloworld', model='text')
+    >>> block[0] == _BLOCK_MODEL, len(block)
+    (True, 17)
+    >>> decompress_block(block)
+    b'helloworld'
+    >>> block = compress_block(bytes(range(256)))
+    >>> block[0] == _BLOCK_STORED, len(block)
+    (True, 265)
+    >>> decompress_block(block) == bytes(range(256))
+    True
+    """
+    freq = build_frequency_dict(text)
+    if model is not None:
+        block_type = _BLOCK_MODEL
+        model_id = _model_id(model)
+        header = bytes([model_id])
+        codes = _model_codes(model_id)
+    else:
+        if max_code_length is None:
+            tree = _build_flat_tree(freq)
+        else:
+            tree = FlatHuffmanTree.from_tree(
+                build_length_limited_tree(freq, max_code_length))
+        codes = tree.codes()
+        if canonical:
+            block_type = _BLOCK_CANONICAL
+            lengths = {symbol: codes[symbol][1] for symbol in codes}
+            header = lengths_to_bytes(lengths)
+            codes = canonical_codes(lengths)
+        else:
+            block_type = _BLOCK_TREE
+            header = tree.to_bytes()
+    if len(header) + _encoded_length(freq, codes) >= len(text):
+        return _stored_block(text)
+    payload = header + compress_bytes(text, codes)
+    return (bytes([block_type]) + int32_to_bytes(len(text))
+            + int32_to_bytes(len(payload)) + payload)
+
+
+def _stored_block(text: bytes) -> bytes:
+    """ Return the block of a version 2 file that stores <text> uncompressed.
+    """
+    return (bytes([_BLOCK_STORED]) + int32_to_bytes(len(text))
+            + int32_to_bytes(len(text)) + text)
+
+
+def _encoded_length(freq: dict[int, int],
+                    codes: dict[int, tuple[int, int]]) -> int:
+    """ Return the number of bytes that the text with the byte frequencies in
+    <freq> is compressed to with <codes>.
+
+    >>> _encoded_length({3: 2, 2: 7, 9: 1}, {3: (0, 2), 2: (1, 2), 9: (1, 1)})
+    3
+    """
+    return (sum(freq[byte] * codes[byte][1] for byte in freq) + 7) // 8
+
+
+def decompress_block(block: bytes) -> bytes:
+    """ Return the bytes stored in <block>, a block of a version 2 file.
+
+    Raise DjertyFileError if <block> is not a valid block.
+    """
+    if len(block) < 9 or len(block) != 9 + bytes_to_int(block[5:9]):
+        raise DjertyFileError('one of its blocks is truncated')
+    size = bytes_to_int(block[1:5])
+    if block[0] == _BLOCK_TREE:
+        num_nodes = block[9] if len(block) > 9 else 0
+        if num_nodes == 0 or len(block) < 10 + num_nodes * 4:
+            raise DjertyFileError('the tree of one of its blocks is truncated')
+        table = _tree_decode_table(bytes(block[10:10 + num_nodes * 4]))
+        decoded, _ = table.decode(block[10 + num_nodes * 4:])
+    elif block[0] == _BLOCK_CANONICAL:
+        table, start = _canonical_decode_table(block, 9)
+        decoded, _ = table.decode(block[start:])
+    elif block[0] == _BLOCK_MODEL:
+        if len(block) < 10 or block[9] >= len(MODEL_NAMES):
+            raise DjertyFileError('the model of one of its blocks is unknown')
+        decoded, _ = _model_decode_table(block[9]).decode(block[10:])
+    elif block[0] == _BLOCK_STORED:
+        decoded = bytes(block[9:])
+        if len(decoded) != size:
+            raise DjertyFileError('one of its stored blocks has the wrong '
+                                  'size')
+    else:
+        raise DjertyFileError(f'its block type {block[0]} is unknown')
+    if len(decoded) < size:
+        raise DjertyFileError('one of its blocks is truncated')
+    return decoded[:size]
+
+
+def _check_block_size(block_size: int) -> None:
+    """ Raise ValueError if <block_size> is not a valid block size. """
+    if not 0 < block_size <= MAX_BLOCK_SIZE:
+        raise ValueError(f'block_size must be between 1 and {MAX_BLOCK_SIZE}')
+
+
+def _compress_blocks(in_file: str, block_size: int, use_mmap: bool,
+                     canonical: bool,
+                     max_code_length: Optional[int],
+                     model: Optional[str]) -> Iterator[bytes]:
+    """ Yield the blocks that store the contents of <in_file>, using blocks
+    of <block_size> bytes, reading <in_file> through a memory map if
+    <use_mmap> is True (see compress_block for the other parameters). """
+    with _open_input(in_file, use_mmap) as f1:
+        for text in _read_chunks(f1, block_size):
+            yield compress_block(text, canonical, max_code_length, model)
+
+
+def _store_blocks(in_file: str, block_size: int,
+                  use_mmap: bool) -> Iterator[bytes]:
+    """ Yield stored blocks that hold the contents of <in_file>, <block_size>
+    bytes each, reading it through a memory map if <use_mmap> is True. """
+    with _open_input(in_file, use_mmap) as f1:
+        for text in _read_chunks(f1, block_size):
+            yield _stored_block(text)
+
+
+def _unindexed_header(block_size: int) -> bytes:
+    """ Return the header of an unindexed version 2 file with blocks of
+    <block_size> bytes. """
+    return MAGIC + bytes([VERSION_BLOCKS, 0]) + int32_to_bytes(block_size)
+
+
+def _write_blocks_file(out_file: str, size: int, block_size: int,
+                       blocks: Iterable[bytes]) -> None:
+    """ Write the version 2 file <out_file>, which stores <size> bytes in
+    <blocks>, compressed from <block_size> bytes each. The file is indexed
+    unless it has at most one block, which does not need an index. """
+    num_blocks = -(-size // block_size)
+    with open(out_file, "wb") as f2:
+        if num_blocks <= 1:
+            f2.write(_unindexed_header(block_size))
+            for block in blocks:
+                f2.write(block)
+            f2.write(bytes([_BLOCK_END]))
+            return
+        f2.write(MAGIC + bytes([VERSION_BLOCKS, _FLAG_INDEXED])
+                 + int32_to_bytes(block_size) + int64_to_bytes(size)
+                 + int32_to_bytes(num_blocks))
+        # the index is only known once every block has been compressed, so
+        # space is left for it here and it is filled in at the end.
+        index_position = f2.tell()
+        f2.write(bytes(4 * num_blocks))
+        lengths = []
+        for block in blocks:
+            lengths.append(len(block))
+            f2.write(block)
+        f2.write(bytes([_BLOCK_END]))
+        if len(lengths) != num_blocks:
+            raise OSError(f'{out_file}: the input changed size while being '
+                          f'compressed')
+        f2.seek(index_position)
+        f2.write(b''.join(int32_to_bytes(length) for length in lengths))
+
+
+def _read_blocks_header(f: BinaryIO) -> Optional[list[int]]:
+    """ Read the rest of the header of the version 2 file <f>, which is open
+    right after its version byte. Return the lengths of its blocks if it is
+    indexed, or None otherwise.
+
+    Raise DjertyFileError if the header is not valid (see
+    _check_blocks_header), or a block in its index is longer than any valid
+    block.
+    """
+    header = f.read(5)
+    if len(header) == 5 and header[0] & _FLAG_INDEXED:
+        header += f.read(12)
+    num_blocks = _check_blocks_header(header)
+    if num_blocks is None:
+        return None
+    # the index is read a chunk at a time, so that a truncated file is
+    # reported before the index it claims to have is held in memory.
+    lengths = []
+    while len(lengths) < num_blocks:
+        count = min(num_blocks - len(lengths), CHUNK_SIZE // 4)
+        index = f.read(4 * count)
+        if len(index) != 4 * count:
+            raise DjertyFileError('its block index is truncated')
+        lengths.extend(bytes_to_int(index[i:i + 4])
+                       for i in range(0, len(index), 4))
+    if any(length > 9 + _MAX_PAYLOAD_LENGTH for length in lengths):
+        raise DjertyFileError('one of its blocks is too long')
+    return lengths
+
+
+def _check_blocks_header(header: bytes) -> Optional[int]:
+    """ Return the number of blocks of a version 2 file whose header (after
+    its version byte, and without its index) is <header>, or None if it is
+    not indexed.
+
+    Raise DjertyFileError if <header> is truncated, its block size is not a
+    valid block size, or its number of blocks does not match its size.
+
+    >>> _check_blocks_header(bytes([1, 0, 0, 1, 0]) + int64_to_bytes(1 << 17) \
+    + bytes([2, 0, 0, 0]))
+    2
+    >>> try:
+    ...     _check_blocks_header(bytes([1, 0, 0, 1, 0]) + \
+    int64_to_bytes(1 << 17) + bytes([255, 255, 255, 255]))
+    ... except DjertyFileError as error:
+    ...     print(error.reason)
+    its number of blocks does not match its size
+    """
+    if len(header) < 5:
+        raise DjertyFileError('its header is truncated')
+    block_size = bytes_to_int(header[1:5])
+    if not 0 < block_size <= MAX_BLOCK_SIZE:
+        raise DjertyFileError(f'its block size ({block_size}) is not valid')
+    if not header[0] & _FLAG_INDEXED:
+        return None
+    if len(header) < 17:
+        raise DjertyFileError('its header is truncated')
+    num_blocks = bytes_to_int(header[13:17])
+    if num_blocks != -(-bytes_to_int(header[5:13]) // block_size):
+        raise DjertyFileError('its number of blocks does not match its size')
+    return num_blocks
+
+
+def _read_block(f: BinaryIO) -> Optional[bytes]:
+    """ Return the next block of the version 2 file <f>, or None if there are
+    no more blocks.
+
+    Raise DjertyFileError if the block is truncated or longer than any valid
+    block.
+    """
+    head = f.read(1)
+    if head == bytes([_BLOCK_END]):
+        return None
+    head += f.read(8)
+    if len(head) != 9:
+        raise DjertyFileError('it ends before its last block')
+    length = bytes_to_int(head[5:9])
+    if length > _MAX_PAYLOAD_LENGTH:
+        raise DjertyFileError('one of its blocks is too long')
+    payload = f.read(length)
+    return head + payload
+
+
+def _iter_blocks(f: BinaryIO) -> Iterator[bytes]:
+    """ Yield the remaining blocks of the version 2 file <f>. """
+    block = _read_block(f)
+    while block is not None:
+        yield block
+        block = _read_block(f)
+
+
+def _decompress_blocks(f: BinaryIO, g: BinaryIO) -> None:
+    """ Decompress the version 2 file <f>, which is open right after its
+    version byte, into <g>, one block at a time. """
+    _read_blocks_header(f)
+    for block in _iter_blocks(f):
+        g.write(decompress_block(block))
+
+
+# ====================
+# Incremental compression and decompression
+#
+# Compressor and Decompressor work on a stream of chunks, in the style of
+# zlib.compressobj and zlib.decompressobj, so that data can be passed through
+# them without ever being stored in a file or held in memory in full.
+
+
+class Compressor:
+    """ An object that compresses a stream of data, one chunk at a time, into
+    an unindexed version 2 file.
+
+    Every <block_size> bytes of data are compressed into a block as soon as
+    they have been passed in, so at most one block of data is buffered.
+
+    >>> c = Compressor(block_size=4)
+    >>> out = c.update(b'hello') + c.update(b'world') + c.flush()
+    >>> d = Decompressor()
+    >>> d.update(out) + d.flush()
+    b'helloworld'
+    """
+    # Private Attributes:
+    # _block_size: the number of bytes of data in each block
+    # _canonical: whether the blocks use canonical Huffman codes
+    # _max_code_length: the length limit of the codes, or None
+    # _model: the name of the static model the blocks use, or None
+    # _stored: whether the blocks are stored without being compressed
+    # _buffer: the data that has not been compressed yet
+    # _started: whether the file header has been returned yet
+    # _finished: whether flush has been called
+
+    _block_size: int
+    _canonical: bool
+    _max_code_length: Optional[int]
+    _model: Optional[str]
+    _stored: bool
+    _buffer: bytearray
+    _started: bool
+    _finished: bool
+
+    def __init__(self, block_size: int = BLOCK_SIZE, canonical: bool = False,
+                 max_code_length: Optional[int] = None,
+                 model: Optional[str] = None, stored: bool = False) -> None:
+        """ Initialize a new Compressor that compresses blocks of
+        <block_size> bytes, or only stores them if <stored> is True (see
+        compress_block for the other parameters). """
+        _check_block_size(block_size)
+        if model is not None:
+            _model_id(model)
+        self._block_size = block_size
+        self._canonical = canonical
+        self._max_code_length = max_code_length
+        self._model = model
+        self._stored = stored
+        self._buffer = bytearray()
+        self._started = False
+        self._finished = False
+
+    def update(self, chunk: bytes) -> bytes:
+        """ Add <chunk> to the data being compressed, and return the
+        compressed data that is ready to be written out, which may be empty.
+        """
+        if self._finished:
+            raise ValueError('update called after flush')
+        self._buffer += chunk
+        out = [self._header()]
+        if len(self._buffer) >= self._block_size:
+            size = self._block_size
+            with memoryview(self._buffer) as view:
+                for start in range(0, len(view) - size + 1, size):
+                    out.append(self._compress(view[start:start + size]))
+            del self._buffer[:len(self._buffer) - len(self._buffer) % size]
+        return b''.join(out)
+
+    def flush(self) -> bytes:
+        """ Compress the rest of the data, and return the end of the
+        compressed file. No more data can be added afterwards. """
+        if self._finished:
+            raise ValueError('flush called twice')
+        out = self._header()
+        if self._buffer:
+            out += self._compress(self._buffer)
+            self._buffer = bytearray()
+        self._finished = True
+        return out + bytes([_BLOCK_END])
+
+    def _header(self) -> bytes:
+        """ Return the file header if it has not been returned yet, or an
+        empty bytes object otherwise. """
+        if self._started:
+            return bytes([])
+        self._started = True
+        return _unindexed_header(self._block_size)
+
+    def _compress(self, text: bytes) -> bytes:
+        """ Return the block that stores <text>. """
+        if self._stored:
+            return _stored_block(text)
+        return compress_block(text, self._canonical, self._max_code_length,
+                              self._model)
+
+
+def compress_stream(chunks: Iterable[bytes], block_size: int = BLOCK_SIZE,
+                    stored: bool = False, parallel: bool = False) \
+        -> Iterator[bytes]:
+    """ Yield an unindexed version 2 file compressed from the data in
+    <chunks>, like a Compressor would, in blocks of <block_size> bytes that
+    are only stored if <stored> is True.
+
+    If <parallel> is True (and <stored> is not), the blocks are compressed in
+    the shared pool of worker processes (see set_workers), a few at a time.
+    The output is the same either way.
+
+    >>> out = b''.join(compress_stream([b'hello', b'world'], block_size=4))
+    >>> d = Decompressor()
+    >>> d.update(out)
+    b'helloworld'
+    """
+    if stored or not parallel:
+        compressor = Compressor(block_size, stored=stored)
+        for chunk in chunks:
+            yield compressor.update(chunk)
+        yield compressor.flush()
+        return
+    _check_block_size(block_size)
+    yield _unindexed_header(block_size)
+    yield from _imap_ordered(compress_block,
+                             ((text,) for text in _rejoin(chunks, block_size)))
+    yield bytes([_BLOCK_END])
+
+
+def _rejoin(chunks: Iterable[bytes], size: int) -> Iterator[bytes]:
+    """ Yield the data in <chunks> again, in pieces of <size> bytes (the last
+    one may be shorter).
+
+    >>> list(_rejoin([b'abc', b'de', b'fghij'], 4))
+    [b'abcd', b'efgh', b'ij']
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= size:
+            end = len(buffer) - len(buffer) % size
+            for start in range(0, end, size):
+                yield bytes(buffer[start:start + size])
+            del buffer[:end]
+    if buffer:
+        yield bytes(buffer)
+
+
+class Decompressor:
+    """ An object that decompresses a .djerty file of any version, passed in
+    one chunk at a time.
+
+    The decompressed data is returned as soon as it is decoded, and only the
+    parts of the file that cannot be decoded yet are buffered: at most one
+    header (for a version 1 or 3 file) or one block (for a version 2 file).
+
+    === Public Attributes ===
+    eof: whether the end of the compressed file has been reached. Any data
+        passed in after that is ignored.
+
+    >>> d = Decompressor()
+    >>> compressed = bytes([3, 0, 104, 0, 101, 0, 111, 0, 108, 1, 0, 1, 1, \
+    5, 0, 0, 0, 31, 128])
+    >>> out = [d.update(compressed[i:i + 2]) for i in range(0, 19, 2)]
+    >>> b''.join(out), d.eof
+    (b'hello', True)
+    >>> d = Decompressor()
+    >>> d.update(compressed[:13])
+    b''
+    >>> try:
+    ...     d.flush()
+    ... except DjertyFileError as error:
+    ...     print(error.reason)
+    it ends unexpectedly
+    """
+    eof: bool
+
+    # Private Attributes:
+    # _buffer: the data that has been passed in but not used yet
+    # _version: the version of the file, or None if it is not known yet
+    # _table: the decode table of a version 1 or 3 file, once it is known
+    # _state: the state of _table at the end of the data decoded so far
+    # _remaining: the number of bytes a version 1 or 3 file still has to
+    #   decompress to
+    # _blocks_started: whether the header of a version 2 file has been read
+
+    _buffer: bytearray
+    _version: Optional[int]
+    _table: Optional[_DecodeTable]
+    _state: int
+    _remaining: int
+    _blocks_started: bool
+
+    def __init__(self) -> None:
+        """ Initialize a new Decompressor. """
+        self.eof = False
+        self._buffer = bytearray()
+        self._version = None
+        self._table = None
+        self._state = 0
+        self._remaining = 0
+        self._blocks_started = False
+
+    def update(self, chunk: bytes) -> bytes:
+        """ Add <chunk> to the compressed data, and return the data that it
+        lets be decompressed, which may be empty.
+
+        Raise DjertyFileError if the compressed data is not a valid .djerty
+        file.
+        """
+        if self.eof:
+            return bytes([])
+        if self._table is not None:
+            return self._decode(chunk)
+        self._buffer += chunk
+        if self._version is None and not self._read_version():
+            return bytes([])
+        if self._version == VERSION_BLOCKS:
+            return self._read_blocks()
+        if not self._read_stream_header():
+            return bytes([])
+        rest = bytes(self._buffer)
+        self._buffer = bytearray()
+        return self._decode(rest)
+
+    @property
+    def header_read(self) -> bool:
+        """ Return whether the header of the file has been read, so that the
+        rest of it is known to start like a valid .djerty file.
+
+        >>> d = Decompressor()
+        >>> d.update(bytes([3, 0, 104])), d.header_read
+        (b'', False)
+        """
+        return self.eof or self._table is not None or self._blocks_started
+
+    def flush(self) -> bytes:
+        """ Check that the whole compressed file has been passed in, and
+        return an empty bytes object (for compatibility with zlib), or raise
+        DjertyFileError if it has not. """
+        if (self._version == 1 and not self.eof and self._table is None
+                and self._buffer == _LEGACY_EMPTY_FILE):
+            # the version 1 file of empty data, whose size is too short to
+            # be read as one (see _decompress_legacy).
+            self.eof = True
+        if not self.eof:
+            raise DjertyFileError('it ends unexpectedly')
+        return bytes([])
+
+    def _read_version(self) -> bool:
+        """ Read the version of the file from the buffer, and return whether
+        it could be read. """
+        buf = self._buffer
+        if len(buf) >= 1 and buf[0] != MAGIC[0]:
+            self._version = 1
+            return True
+        if len(buf) < len(MAGIC) + 1:
+            return False
+        if buf[:len(MAGIC)] != MAGIC:
+            raise DjertyFileError('it does not start with a valid header')
+        if buf[len(MAGIC)] not in (VERSION_BLOCKS, VERSION_LARGE):
+            raise DjertyFileError(f'its version ({buf[len(MAGIC)]}) is not '
+                                  f'supported')
+        self._version = buf[len(MAGIC)]
+        del buf[:len(MAGIC) + 1]
+        return True
+
+    def _read_stream_header(self) -> bool:
+        """ Read the tree and size of a version 1 or 3 file from the buffer,
+        and return whether they could be read. """
+        buf = self._buffer
+        size_length = 4 if self._version == 1 else 8
+        if not buf or len(buf) < 1 + buf[0] * 4 + size_length:
+            return False
+        num_nodes = buf[0]
+        nodes = bytes(buf[1:1 + num_nodes * 4])
+        start = 1 + num_nodes * 4
+        self._remaining = bytes_to_int(buf[start:start + size_length])
+        del buf[:start + size_length]
+        if self._remaining == 0:
+            self.eof = True
+        else:
+            self._table = _tree_decode_table(nodes)
+            self._state = self._table.root
+        return True
+
+    def _decode(self, text: bytes) -> bytes:
+        """ Decode <text>, the next part of the compressed text of a version 1
+        or 3 file. """
+        decoded, self._state = self._table.decode(text, self._state)
+        if len(decoded) >= self._remaining:
+            decoded = decoded[:self._remaining]
+            self.eof = True
+        self._remaining -= len(decoded)
+        return decoded
+
+    def _read_blocks(self) -> bytes:
+        """ Decompress all the complete blocks of a version 2 file in the
+        buffer. """
+        buf = self._buffer
+        if not self._blocks_started:
+            if len(buf) < 5:
+                return bytes([])
+            header_length = 5
+            if buf[0] & _FLAG_INDEXED:
+                if len(buf) < 17:
+                    return bytes([])
+                header_length = 17
+            num_blocks = _check_blocks_header(bytes(buf[:header_length]))
+            if num_blocks is not None:
+                # the index is not needed to read the blocks in order.
+                header_length += 4 * num_blocks
+                if len(buf) < header_length:
+                    return bytes([])
+            del buf[:header_length]
+            self._blocks_started = True
+        out = []
+        start = 0
+        while start < len(buf):
+            if buf[start] == _BLOCK_END:
+                self.eof = True
+                start += 1
+                break
+            if len(buf) < start + 9:
+                break
+            length = bytes_to_int(buf[start + 5:start + 9])
+            if length > _MAX_PAYLOAD_LENGTH:
+                raise DjertyFileError('one of its blocks is too long')
+            end = start + 9 + length
+            if len(buf) < end:
+                break
+            out.append(decompress_block(bytes(buf[start:end])))
+            start = end
+        del buf[:start]
+        return b''.join(out)
+
+
+# ====================
+# Functions for parallel compression and decompression
+#
+# The pieces of a file are handed to a pool of worker processes as (file name,
+# offset, length, use_mmap) tuples, and each worker reads its piece from the
+# file itself (or maps it, if use_mmap is True), so that the contents of the
+# file never have to be sent between processes. The pool is created on first
+# use and shared by every call (and so by every request served by this
+# process) until shutdown_workers is called.
+
+_workers: Optional[int] = None
+_executor: Optional[ProcessPoolExecutor] = None
+# the lock that is taken before using _workers and _executor, since requests
+# served by different threads share the pool
+_executor_lock = threading.Lock()
+
+
+def set_workers(workers: Optional[int]) -> None:
+    """ Set the number of worker processes used for parallel compression and
+    decompression to <workers>, or to the number of CPUs if it is None. The
+    current pool, if any, is shut down if its size changes. """
+    global _workers
+    if workers is not None and workers < 1:
+        raise ValueError('there must be at least one worker')
+    with _executor_lock:
+        if workers == _workers:
+            return
+        _workers = workers
+        old = _detach_executor()
+    if old is not None:
+        old.shutdown()
+
+
+def shutdown_workers() -> None:
+    """ Shut down the pool of worker processes, if it has been started. A new
+    pool is started the next time one is needed.
+
+    Calls that are running in the pool are finished first, and any calls
+    still being submitted go to the new pool. """
+    with _executor_lock:
+        old = _detach_executor()
+    if old is not None:
+        old.shutdown()
+
+
+def _detach_executor() -> Optional[ProcessPoolExecutor]:
+    """ Return the shared pool of worker processes, if it has been started,
+    and forget it, so that the next call starts a new one. The lock must be
+    held. """
+    global _executor
+    old, _executor = _executor, None
+    return old
+
+
+def _submit(func: Callable, *args: Any) -> Future:
+    """ Submit func(*args) to the shared pool of worker processes, starting
+    it if needed, and return its future. """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=_workers)
+        return _executor.submit(func, *args)
+
+
+def _num_workers() -> int:
+    """ Return the number of worker processes in the shared pool. """
+    return _workers if _workers is not None else (os.cpu_count() or 1)
+
+
+def _imap_ordered(func: Callable, args: Iterable[tuple]) -> Iterator[Any]:
+    """ Yield func(*arg) for every arg in <args>, in order, computing them in
+    the shared pool of worker processes. Only a bounded number of calls is
+    submitted ahead of the one being yielded, so that results waiting to be
+    consumed never pile up in memory. """
+    window = 2 * _num_workers()
+    pending = deque()
+    for arg in args:
+        pending.append(_submit(func, *arg))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _pieces(in_file: str, piece_size: int,
+            use_mmap: bool) -> list[tuple[str, int, int, bool]]:
+    """ Return (<in_file>, offset, length, <use_mmap>) tuples that split the
+    contents of <in_file> into pieces of <piece_size> bytes (the last may be
+    shorter). """
+    size = os.path.getsize(in_file)
+    return [(in_file, offset, min(piece_size, size - offset), use_mmap)
+            for offset in range(0, size, piece_size)]
+
+
+def _count_piece(in_file: str, offset: int, length: int,
+                 use_mmap: bool) -> dict[int, int]:
+    """ Return the frequencies of the bytes in a piece of <in_file>. """
+    with _open_piece(in_file, offset, length, use_mmap) as text:
+        return _count_bytes(text)
+
+
+def _encode_piece(in_file: str, offset: int, length: int, use_mmap: bool,
+                  codes: dict[int, tuple[int, int]], start_bit: int) -> bytes:
+    """ Return the compressed form of a piece of <in_file>, using <codes>,
+    shifted right by <start_bit> zero bits so that it can be merged into the
+    last, partial byte of the piece before it. """
+    packer = _BitPacker(codes, start_bit)
+    with _open_piece(in_file, offset, length, use_mmap) as text:
+        return packer.pack(text) + packer.flush()
+
+
+def _compress_block_piece(in_file: str, offset: int, length: int,
+                          use_mmap: bool, canonical: bool,
+                          max_code_length: Optional[int],
+                          model: Optional[str]) -> bytes:
+    """ Return the block of a version 2 file that stores a piece of
+    <in_file>. """
+    with _open_piece(in_file, offset, length, use_mmap) as text:
+        return compress_block(text, canonical, max_code_length, model)
+
+
+def _decompress_block_piece(in_file: str, offset: int, length: int,
+                            use_mmap: bool) -> bytes:
+    """ Return the bytes stored in the block of the version 2 file <in_file>
+    that starts at <offset> and is <length> bytes long. """
+    with _open_piece(in_file, offset, length, use_mmap) as block:
+        return decompress_block(block)
+
+
+def _decompress_blocks_parallel(in_file: str, f: BinaryIO, g: BinaryIO,
+                                use_mmap: bool) -> None:
+    """ Decompress the version 2 file <in_file>, which is open as <f> right
+    after its version byte, into <g>, using the shared pool of worker
+    processes. The blocks are written to <g> in order. """
+    lengths = _read_blocks_header(f)
+    if lengths is None:
+        # without an index, the position of a block is only known once the
+        # one before it has been read, so the blocks are read here and only
+        # their decoding is done by the workers.
+        decoded = _imap_ordered(decompress_block,
+                                ((block,) for block in _iter_blocks(f)))
+    else:
+        pieces = []
+        offset = f.tell()
+        for length in lengths:
+            pieces.append((in_file, offset, length, use_mmap))
+            offset += length
+        # the blocks are not read here, but the file must still end with
+        # _BLOCK_END right after the last of them, like _iter_blocks checks.
+        f.seek(0, os.SEEK_END)
+        if f.tell() <= offset:
+            raise DjertyFileError('it ends before its last block')
+        f.seek(offset)
+        if f.read(1) != bytes([_BLOCK_END]):
+            raise DjertyFileError('it ends before its last block')
+        decoded = _imap_ordered(_decompress_block_piece, pieces)
+    for text in decoded:
+        g.write(text)
+
+
+def _compress_file_parallel(in_file: str, out_file: str, chunk_size: int,
+                            block_size: Optional[int], use_mmap: bool,
+                            canonical: bool,
+                            max_code_length: Optional[int],
+                            model: Optional[str]) -> None:
+    """ Compress <in_file> into <out_file> like compress_file does, using the
+    shared pool of worker processes. """
+    if block_size is not None:
+        _check_block_size(block_size)
+        pieces = [piece + (canonical, max_code_length, model)
+                  for piece in _pieces(in_file, block_size, use_mmap)]
+        _write_blocks_file(out_file, os.path.getsize(in_file), block_size,
+                           _imap_ordered(_compress_block_piece, pieces))
+        return
+    pieces = _pieces(in_file, chunk_size, use_mmap)
+    # count the bytes of every piece in parallel, and then merge the counts,
+    # in order, into the frequencies of the whole file.
+    counts = list(_imap_ordered(_count_piece, pieces))
+    freq = {}
+    for count in counts:
+        _merge_frequencies(freq, count)
+    tree, codes = _prepare_tree(freq, max_code_length)
+    size = sum(piece[2] for piece in pieces)
+    if _no_gain(tree, codes, freq, size):
+        # storing blocks is only a copy, so it is not worth spreading out.
+        _write_blocks_file(out_file, size, BLOCK_SIZE,
+                           _store_blocks(in_file, BLOCK_SIZE, use_mmap))
+        return
+    # the counts also give the number of bits each piece compresses to, and
+    # hence the bit (within a byte) at which each piece starts.
+    start_bits = []
+    total_bits = 0
+    for count in counts:
+        start_bits.append(total_bits & 7)
+        total_bits += sum(count[byte] * codes[byte][1] for byte in count)
+    with open(out_file, "wb") as f2:
+        f2.write(_stream_header(tree, size))
+        partial = 0
+        args = [piece + (codes, start_bit)
+                for piece, start_bit in zip(pieces, start_bits)]
+        for i, encoded in enumerate(_imap_ordered(_encode_piece, args)):
+            # merge the first byte of this piece into the last, partial byte
+            # of the previous piece, and hold back this piece's last byte if
+            # the next piece starts in it.
+            if start_bits[i]:
+                encoded = bytes([encoded[0] | partial]) + encoded[1:]
+            if i + 1 < len(start_bits) and start_bits[i + 1]:
+                partial = encoded[-1]
+                encoded = encoded[:-1]
+            f2.write(encoded)
 
 
 if __name__ == "__main__":
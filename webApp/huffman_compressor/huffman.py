@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+from array import array
 from typing import Optional, Any
 
 
@@ -17,6 +18,7 @@ class HuffmanTree:
     left: left subtree of this Huffman tree
     right: right subtree of this Huffman tree
     """
+    __slots__ = ('symbol', 'number', 'left', 'right')
     symbol: Optional[int]
     number: Optional[int]
     left: Optional[HuffmanTree]
@@ -41,11 +43,23 @@ class HuffmanTree:
         >>> b = HuffmanTree(5)
         >>> a == b
         False
+        >>> HuffmanTree(None, a, b) == HuffmanTree(None, a, HuffmanTree(5))
+        True
         """
-        return (isinstance(self, type(other))
-                and self.symbol == other.symbol
-                and self.left == other.left
-                and self.right == other.right)
+        # the pairs of subtrees that are left to compare, so that deep trees
+        # are compared without recursion.
+        stack = [(self, other)]
+        while stack:
+            t1, t2 = stack.pop()
+            if t1 is None or t2 is None:
+                if t1 is not t2:
+                    return False
+                continue
+            if not isinstance(t1, type(t2)) or t1.symbol != t2.symbol:
+                return False
+            stack.append((t1.right, t2.right))
+            stack.append((t1.left, t2.left))
+        return True
 
     def __lt__(self, other: Any) -> bool:
         """ Return True iff this HuffmanTree is less than <other>."""
@@ -73,6 +87,166 @@ class HuffmanTree:
         return bytes([self.number + 1])
 
 
+class FlatHuffmanTree:
+    """ A Huffman tree stored as two parallel arrays, with the children of each
+    of its internal nodes, in postorder (so the root is the last node).
+
+    A child that is a leaf is stored as its symbol, and a child that is an
+    internal node is stored as 256 plus its index in the arrays. The nodes are
+    in the same order as number_nodes numbers them, so a node's index is its
+    number.
+
+    This takes far less memory than a tree of HuffmanTree objects, and is
+    what the compressor works with internally. Use from_tree and to_tree to
+    convert between the two.
+
+    Public Attributes:
+    ===========
+    left: the left child of every internal node
+    right: the right child of every internal node
+
+    >>> tree = HuffmanTree(None, HuffmanTree(None, HuffmanTree(3), \
+    HuffmanTree(2)), HuffmanTree(5))
+    >>> flat = FlatHuffmanTree.from_tree(tree)
+    >>> list(flat.left), list(flat.right)
+    ([3, 256], [2, 5])
+    >>> flat.to_tree() == tree
+    True
+    """
+    __slots__ = ('left', 'right')
+    left: array
+    right: array
+
+    def __init__(self, left: array, right: array) -> None:
+        """ Create a new flat Huffman tree whose internal nodes have the
+        children in <left> and <right>.
+
+        Precondition: <left> and <right> are in postorder, as described above.
+        """
+        self.left, self.right = left, right
+
+    @classmethod
+    def from_tree(cls, tree: HuffmanTree) -> FlatHuffmanTree:
+        """ Return the flat form of <tree>.
+
+        Precondition: <tree> is not a leaf.
+        """
+        left, right = array('H'), array('H')
+        # each stack entry is a node together with whether its children have
+        # already been flattened.
+        stack = [(tree, False)]
+        indices = []
+        while stack:
+            node, visited = stack.pop()
+            if node.is_leaf():
+                indices.append(node.symbol)
+            elif visited:
+                r = indices.pop()
+                left.append(indices.pop())
+                right.append(r)
+                indices.append(256 + len(left) - 1)
+            else:
+                stack.append((node, True))
+                stack.append((node.right, False))
+                stack.append((node.left, False))
+        return cls(left, right)
+
+    @classmethod
+    def from_children(cls, left: list[int], right: list[int],
+                      root: int) -> FlatHuffmanTree:
+        """ Return the flat form of the tree whose root is the internal node
+        at index <root>, where internal nodes are given in any order by their
+        children in <left> and <right> (encoded as described above).
+
+        >>> flat = FlatHuffmanTree.from_children([256 + 1, 3], [5, 2], 0)
+        >>> list(flat.left), list(flat.right)
+        ([3, 256], [2, 5])
+        """
+        new_left, new_right = array('H'), array('H')
+        # the new index of every node, once it has been placed
+        placed = {}
+        stack = [(root, False)]
+        while stack:
+            node, visited = stack.pop()
+            if visited:
+                children = []
+                for child in (left[node], right[node]):
+                    children.append(child if child < 256
+                                    else 256 + placed[child - 256])
+                placed[node] = len(new_left)
+                new_left.append(children[0])
+                new_right.append(children[1])
+            else:
+                stack.append((node, True))
+                if right[node] >= 256:
+                    stack.append((right[node] - 256, False))
+                if left[node] >= 256:
+                    stack.append((left[node] - 256, False))
+        return cls(new_left, new_right)
+
+    def __len__(self) -> int:
+        """ Return the number of internal nodes of this tree. """
+        return len(self.left)
+
+    def to_tree(self) -> HuffmanTree:
+        """ Return this tree as a tree of HuffmanTree objects. """
+        nodes = []
+        for l, r in zip(self.left, self.right):
+            nodes.append(HuffmanTree(
+                None, HuffmanTree(l) if l < 256 else nodes[l - 256],
+                HuffmanTree(r) if r < 256 else nodes[r - 256]))
+        return nodes[-1]
+
+    def to_bytes(self) -> bytes:
+        """ Return the number of nodes of this tree, followed by the bytes
+        representation of its nodes in postorder, as they are stored in a
+        compressed file.
+
+        An empty tree (the tree of an empty text) has no nodes, but is
+        written with a number of nodes of 1, like an empty HuffmanTree.
+
+        >>> list(FlatHuffmanTree(array('H', [3, 256]), \
+        array('H', [2, 5])).to_bytes())
+        [2, 0, 3, 0, 2, 1, 0, 0, 5]
+        >>> list(FlatHuffmanTree(array('H'), array('H')).to_bytes())
+        [1]
+        """
+        if not self.left:
+            return bytes([1])
+        buf = bytearray(1 + 4 * len(self.left))
+        buf[0] = len(self.left)
+        i = 1
+        for l, r in zip(self.left, self.right):
+            buf[i:i + 4] = bytes([l >= 256, l & 0xFF, r >= 256, r & 0xFF])
+            i += 4
+        return bytes(buf)
+
+    def codes(self) -> dict[int, tuple[int, int]]:
+        """ Return a dictionary which maps the symbols of this tree to their
+        codes, as (value, length) pairs (like get_int_codes), with the symbols
+        in the order their leaves appear from left to right.
+
+        >>> FlatHuffmanTree(array('H', [3, 256]), array('H', [2, 5])).codes()
+        {3: (0, 2), 2: (1, 2), 5: (1, 1)}
+        >>> FlatHuffmanTree(array('H'), array('H')).codes()
+        {}
+        """
+        d = {}
+        if not self.left:
+            return d
+        left, right = self.left, self.right
+        stack = [(256 + len(left) - 1, 0, 0)]
+        while stack:
+            child, value, length = stack.pop()
+            if child < 256:
+                d[child] = (value, length)
+                continue
+            node = child - 256
+            stack.append((right[node], (value << 1) | 1, length + 1))
+            stack.append((left[node], value << 1, length + 1))
+        return d
+
+
 if __name__ == '__main__':
     import doctest
     doctest.testmod()
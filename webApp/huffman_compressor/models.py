@@ -0,0 +1,48 @@
+"""
+=== Module Description ===
+This module contains the static models that huffman_compressor.engine can
+compress blocks with (see compress_block). Each model is the frequency of
+every one of the 256 possible bytes, as returned by engine.train_model.
+
+A compressed block refers to its model by the model's index in MODEL_NAMES,
+so a model must never be changed or removed once it has been released, and
+new models must only be added at the end of MODEL_NAMES.
+"""
+
+# trained on the Python documentation topics (pydoc_data.topics), as a model
+# of English text with some code in it
+_TEXT = (
+    1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1600, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1,
+    1, 1, 1, 1, 1, 1, 1, 1, 12070, 6, 1136, 11, 1, 7, 2, 152, 364, 364, 559,
+    85, 477, 1708, 684, 16, 67, 79, 47, 55, 26, 17, 12, 11, 10, 6, 205, 39,
+    28, 440, 126, 2, 4, 80, 22, 66, 20, 79, 53, 11, 10, 108, 1, 4, 18, 28, 70,
+    23, 70, 1, 29, 67, 187, 21, 7, 26, 5, 5, 2, 74, 11, 74, 5, 697, 1, 3313,
+    767, 1683, 1460, 5804, 962, 664, 1562, 3165, 143, 165, 1811, 1076, 3166,
+    2842, 1046, 74, 2591, 3178, 4388, 1229, 344, 387, 344, 608, 34, 20, 183,
+    20, 22, 1, 81, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 2, 3,
+    1, 1, 1, 5, 39, 1, 1, 15, 16, 1, 1, 1, 1, 1, 1, 1, 1, 3, 1, 1, 1, 1, 1, 1,
+    1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1,
+    1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1,
+    1, 1, 1, 81, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1,
+    1, 1, 1, 1, 1, 1, 1, 1, 1,
+)
+
+# trained on the web app's templates (webApp/templates/*.html)
+_HTML = (
+    1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1042, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1,
+    1, 1, 1, 1, 1, 1, 1, 1, 7647, 203, 1819, 33, 1, 604, 1, 15, 43, 43, 1,
+    227, 71, 1117, 274, 971, 326, 344, 255, 330, 401, 288, 297, 269, 382, 260,
+    170, 5, 1225, 915, 1225, 15, 1, 882, 434, 434, 425, 330, 302, 307, 429,
+    415, 297, 260, 311, 326, 344, 260, 340, 387, 349, 302, 392, 359, 250, 311,
+    297, 349, 269, 10, 1, 10, 1, 1, 1, 2479, 980, 1315, 1334, 3228, 980, 787,
+    1023, 2055, 349, 608, 2069, 1042, 2196, 2479, 1348, 180, 1814, 2059, 2827,
+    896, 712, 528, 448, 735, 250, 330, 1, 330, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1,
+    1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1,
+    1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1,
+    1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1,
+    1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1,
+    1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1,
+)
+
+MODEL_NAMES = ('text', 'html')
+MODELS = {'text': _TEXT, 'html': _HTML}
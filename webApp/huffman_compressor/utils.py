@@ -79,6 +79,18 @@ def int32_to_bytes(num: int) -> bytes:
     return num.to_bytes(4, "little")
 
 
+def int64_to_bytes(num: int) -> bytes:
+    """ Return the <num> integer converted to an 8-byte little-endian bytes
+    object.
+
+    >>> list(int64_to_bytes(300))
+    [44, 1, 0, 0, 0, 0, 0, 0]
+    >>> bytes_to_int(int64_to_bytes(5 * 2 ** 32))
+    21474836480
+    """
+    return num.to_bytes(8, "little")
+
+
 class ReadNode:
     """ A node as read from a compressed file.
     Each node consists of type and data information as described in the handout.
@@ -91,6 +103,7 @@ class ReadNode:
     r_type: 0/1 (if the corresponding HuffmanTree's right is a leaf)
     r_data: a symbol or the node number of a HuffmanTree's right
     """
+    __slots__ = ('l_type', 'l_data', 'r_type', 'r_data')
     l_type: int
     l_data: int
     r_type: int